@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict
+
+from starlette.responses import JSONResponse
+
+### Admission control of /chat/stream.
+### Every request waits for the previous turns of its thread (turns are applied in order, never concurrently
+### on the same checkpoint), then for one of `max_concurrent` slots, which caps the parallel LLM calls.
+### Waiting is bounded in length and time, past that the request is rejected right away with a 503 so
+### overload shows up as fast failures instead of timeouts piling up. Clients are also rate limited.
+### The thread locks are per process. Workers sharing the SQLite checkpointer (launcher.py) also take a
+### file lock of the thread (`ThreadFileLocks`), so two turns of a conversation never run on two workers at once.
+
+
+class Rejected(Exception):
+    def __init__(self, status_code, reason, detail, retry_after = 1):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+
+    def response(self):
+        return JSONResponse(status_code=self.status_code, content={"detail": self.detail},
+                            headers={"Retry-After": str(self.retry_after)})
+
+
+class ThreadFileLocks:
+    def __init__(self, directory, stripes = 1024, poll_interval = 0.02):
+        """
+        Exclusive `flock` per thread shared by the processes of one host. The threads are hashed over a fixed
+        number of lock files, so the directory never grows, two threads sharing a file only wait for each other.
+
+        Args:
+            directory (str): Directory of the lock files, the same for every process.
+            stripes (int): Number of lock files.
+            poll_interval (float): Seconds between two attempts to take a busy lock.
+        """
+        import fcntl
+        self.fcntl = fcntl
+        self.directory = directory
+        self.stripes = stripes
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, thread_id):
+        stripe = int.from_bytes(hashlib.sha256(thread_id.encode('utf-8')).digest()[:8], 'little') % self.stripes
+        return os.path.join(self.directory, f'{stripe}.lock')
+
+    async def acquire(self, thread_id, timeout):
+        """
+        Takes the lock of the thread, polling so the wait can be cancelled. Returns the callback releasing it.
+        """
+        fd = os.open(self.path(thread_id), os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                try:
+                    self.fcntl.flock(fd, self.fcntl.LOCK_EX | self.fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise Rejected(503, 'queue_timeout', 'Server busy, try again later')
+                    await asyncio.sleep(self.poll_interval)
+        except BaseException:
+            os.close(fd)
+            raise
+        ### Closing the file releases the lock, also when the process dies
+        return lambda: os.close(fd)
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent = 32, max_queued = 64, queue_timeout = 10.0, max_thread_queue = 2,
+                 thread_locks = None):
+        """
+        Args:
+            max_concurrent (int): Requests running the graph at the same time.
+            max_queued (int): Requests allowed to wait, for a slot or for their thread, before rejecting new ones.
+            queue_timeout (float): Seconds a request waits at most before being rejected.
+            max_thread_queue (int): Turns of the same thread allowed to wait behind the running one.
+            thread_locks (ThreadFileLocks, optional): Also orders the turns of a thread across processes.
+        """
+        self.thread_locks = thread_locks
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.max_thread_queue = max_thread_queue
+        self.queued = 0
+        ### thread_id -> [lock, requests holding or waiting for it]
+        self.threads = {}
+
+    async def wait(self, primitive):
+        ### A free lock or slot is taken right away, only the requests that actually wait count in the queue
+        if not primitive.locked():
+            await primitive.acquire()
+            return
+        if self.queued >= self.max_queued:
+            raise Rejected(503, 'overloaded', 'Server overloaded, try again later')
+        self.queued += 1
+        try:
+            await asyncio.wait_for(primitive.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise Rejected(503, 'queue_timeout', 'Server busy, try again later')
+        finally:
+            self.queued -= 1
+
+    async def acquire(self, thread_id):
+        """
+        Waits for the turn of the thread, then for a free slot. Returns the callback releasing both.
+        """
+        entry = self.threads.setdefault(thread_id, [asyncio.Lock(), 0])
+        if entry[1] > self.max_thread_queue:
+            raise Rejected(429, 'thread_busy', 'Too many pending messages in this conversation')
+        entry[1] += 1
+        release_file = None
+        try:
+            await self.wait(entry[0])
+            try:
+                if self.thread_locks is not None:
+                    release_file = await self.thread_locks.acquire(thread_id, self.queue_timeout)
+                await self.wait(self.slots)
+            except BaseException:
+                if release_file:
+                    release_file()
+                entry[0].release()
+                raise
+        except BaseException:
+            self.leave(thread_id, entry)
+            raise
+
+        released = False
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.slots.release()
+                if release_file:
+                    release_file()
+                entry[0].release()
+                self.leave(thread_id, entry)
+        return release
+
+    def leave(self, thread_id, entry):
+        entry[1] -= 1
+        if entry[1] == 0 and self.threads.get(thread_id) is entry:
+            del self.threads[thread_id]
+
+
+class RateLimiter:
+    def __init__(self, per_minute = 30, burst = 10, max_clients = 10000):
+        """
+        Token bucket per client.
+
+        Args:
+            per_minute (float): Sustained requests per minute of a client.
+            burst (int): Requests a client can send at once after being idle.
+            max_clients (int): Buckets kept in memory, the least recently seen clients are forgotten first.
+        """
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+
+    def check(self, client):
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[client] = (tokens, now)
+            raise Rejected(429, 'rate_limit', 'Too many requests, slow down',
+                           retry_after=math.ceil((1 - tokens) / self.rate))
+        self.buckets[client] = (tokens - 1, now)
+        while len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
@@ -1,9 +1,8 @@
 import streamlit as st
-import requests
 from uuid import uuid4
 import os
-from time import sleep
 import streamlit.components.v1 as components
+from chat_client import ChatClient, coalesce
 import dotenv
 dotenv.load_dotenv()
 
@@ -123,23 +122,27 @@ if st.session_state.page == "chat":
     show_sidebar()
 
 # --- Stream response function ---
+@st.cache_resource
+def get_client():
+    ### Shared by all the sessions of the app, so the connections to the server are reused
+    return ChatClient(URI, os.environ.get('SECRET_KEY'))
+
+def forwarded_for():
+    ### Address of the user as seen by this app, passed on so the server rate limits each user, not the app
+    context = getattr(st, 'context', None)
+    headers = getattr(context, 'headers', None) or {}
+    address = getattr(context, 'ip_address', None)
+    chain = [part for part in (headers.get('X-Forwarded-For'), address) if part]
+    return ', '.join(chain) or None
+
 def stream_response(user_input):
-    payload = {
-        "user_input": user_input,
-        "thread_id": st.session_state.user_session_id
-    }
-    headers = {"Content-Type": "application/json"}
-    headers["X-SECRET-KEY"] = os.environ.get('SECRET_KEY')
     st.session_state.current_response = ""
     st.session_state.streaming = True
 
     try:
-        with requests.post(URI, json=payload, headers=headers, stream=True) as res:
-            for chunk in res.iter_content(chunk_size=5):
-                if chunk:
-                    text_chunk = chunk.decode("utf-8")
-                    st.session_state.current_response += text_chunk
-                    yield text_chunk
+        for text_chunk in get_client().stream(user_input, st.session_state.user_session_id, forwarded_for=forwarded_for()):
+            st.session_state.current_response += text_chunk
+            yield text_chunk
     except Exception as e:
         yield f"Error: {str(e)}"
     finally:
@@ -176,6 +179,26 @@ def speak_with_js(text):
 def add_message(role, content):
     st.session_state.chat_history.append({"role": role, "content": content})
 
+def bot_bubble(content):
+    return f"""
+    <div class='avatar-container'>
+        <img class='avatar-img' src='https://cdn-icons-png.flaticon.com/512/4712/4712109.png'>
+        <div class='message-bubble'>{content}</div>
+    </div>
+    """
+
+@st.cache_data(max_entries=4096)
+def message_html(role, content):
+    ### Past messages never change, their HTML is built once and kept across the reruns of the script
+    if role == "user":
+        return f"""
+        <div class='avatar-container' style='justify-content: flex-end;'>
+            <div class='message-bubble user-bubble'>{content}</div>
+            <img class='avatar-img' src='https://cdn-icons-png.flaticon.com/512/1144/1144760.png'>
+        </div>
+        """
+    return bot_bubble(content)
+
 # --- Pages ---
 def render_home():
     st.markdown(f'<div class="app-title">{app_name}</div>', unsafe_allow_html=True)
@@ -209,52 +232,22 @@ def render_chat():
         if submit and user_input and not st.session_state.streaming:
             add_message("user", user_input)
             placeholder = st.empty()
-            full_response = "Thinking..."
-            placeholder.markdown(f"""
-                <div class='avatar-container'>
-                    <img class='avatar-img' src='https://cdn-icons-png.flaticon.com/512/4712/4712109.png'>
-                    <div class='message-bubble'>{full_response}</div>
-                </div>
-                """, unsafe_allow_html=True)
-            for chunk in stream_response(user_input):
-                if full_response == "Thinking...":
-                    full_response = ""
-                full_response += chunk
-                placeholder.markdown(f"""
-                <div class='avatar-container'>
-                    <img class='avatar-img' src='https://cdn-icons-png.flaticon.com/512/4712/4712109.png'>
-                    <div class='message-bubble'>{full_response}</div>
-                </div>
-                """, unsafe_allow_html=True)
-                sleep(0.1)
+            full_response = ""
+            placeholder.markdown(bot_bubble("Thinking..."), unsafe_allow_html=True)
+            ### Redrawn at most every 50 ms with everything received so far, however the server chunks it
+            for full_response in coalesce(stream_response(user_input)):
+                placeholder.markdown(bot_bubble(full_response), unsafe_allow_html=True)
             add_message("assistant", full_response)
             placeholder.empty()
             speak_with_js(full_response)
             st.rerun()
 
-    for message in reversed(st.session_state.chat_history):
-        if message["role"] == "user":
-            st.markdown(f"""
-            <div class='avatar-container' style='justify-content: flex-end;'>
-                <div class='message-bubble user-bubble'>{message['content']}</div>
-                <img class='avatar-img' src='https://cdn-icons-png.flaticon.com/512/1144/1144760.png'>
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class='avatar-container'>
-                <img class='avatar-img' src='https://cdn-icons-png.flaticon.com/512/4712/4712109.png'>
-                <div class='message-bubble'>{message['content']}</div>
-            </div>
-            """, unsafe_allow_html=True)
+    ### One element for the whole history instead of one per message
+    history = [message_html(message["role"], message["content"]) for message in reversed(st.session_state.chat_history)]
+    st.markdown(''.join(history), unsafe_allow_html=True)
 
     if st.session_state.streaming:
-        st.markdown(f"""
-        <div class='avatar-container'>
-            <img class='avatar-img' src='https://cdn-icons-png.flaticon.com/512/4712/4712109.png'>
-            <div class='message-bubble'>Thinking...</div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(bot_bubble("Thinking..."), unsafe_allow_html=True)
 
 # --- Main Execution ---
 if st.session_state.page == "home":
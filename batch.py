@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from uuid import uuid4
+
+from checkpointer import SQLiteSaver, discard_unfinished_turn
+from metrics import start_trace
+from resilience import request_budget
+
+import dotenv
+dotenv.load_dotenv()
+
+### Batch question answering over a JSONL file, for evaluation and regression runs.
+### Questions are read lazily in windows, the embeddings of a whole window are fetched with one batched
+### request (they land in the embedding cache, so the retriever does not call the Space again), and the
+### graph runs with bounded concurrency. Results are appended to the output as soon as they are ready,
+### a second run with the same output skips the questions that already have a result. The conversations are
+### checkpointed next to the output, so the later turns of a thread still see the earlier ones after a restart.
+###
+###   python batch.py questions.jsonl answers.jsonl --concurrency 8
+
+
+def read_items(path, question_key, id_key):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            question = item.get(question_key) or item.get('user_input') or item.get('question')
+            yield {
+                'id': str(item.get(id_key, line_number)),
+                'question': question,
+                'thread_id': item.get('thread_id'),
+            }
+
+
+def read_done_ids(path):
+    done = set()
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    ### Last line of an interrupted run
+                    continue
+                if result.get('error') is None:
+                    done.add(result['id'])
+    return done
+
+
+def node_timings(trace):
+    timings = defaultdict(float)
+    for span in trace['spans']:
+        if span['name'].startswith('node:'):
+            timings[span['name'][5:]] += span['duration_ms']
+    return dict(timings)
+
+
+async def run_batch(agent, workflow, input_path, output_path, concurrency = 8, window = 64,
+                    question_key = 'user_input', id_key = 'id'):
+    resuming = os.path.exists(output_path)
+    done = read_done_ids(output_path)
+    queue = asyncio.Queue(maxsize=window * 2)
+    thread_locks = defaultdict(asyncio.Lock)
+    counts = {'done': 0, 'skipped': 0, 'errors': 0}
+    output = open(output_path, 'a', encoding='utf-8')
+
+    async def producer():
+        items = []
+        for item in read_items(input_path, question_key, id_key):
+            if item['id'] in done or not item['question']:
+                counts['skipped'] += 1
+                continue
+            items.append(item)
+            if len(items) == window:
+                await prefetch_and_queue(items)
+                items = []
+        if items:
+            await prefetch_and_queue(items)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def prefetch_and_queue(items):
+        ### One batched embedding request for the whole window fills the embedding cache,
+        ### if it fails the questions are still embedded one by one by the graph
+        try:
+            await agent.embedding_model.aembed_documents([item['question'] for item in items])
+        except Exception as e:
+            print(f'Embedding prefetch failed: {type(e).__name__}: {e}')
+        for item in items:
+            await queue.put(item)
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            ### Turns of the same thread run in order, different threads run concurrently
+            thread_id = item['thread_id'] or str(uuid4())
+            async with thread_locks[thread_id] if item['thread_id'] else nullcontext():
+                trace = start_trace(thread_id=thread_id)
+                start = time.perf_counter()
+                result = {'id': item['id'], 'question': item['question'], 'thread_id': thread_id}
+                try:
+                    if resuming and item['thread_id']:
+                        ### A turn interrupted by the previous run is dropped from the history before it runs again
+                        await discard_unfinished_turn(workflow, thread_id)
+                    with request_budget(float(os.environ.get('REQUEST_BUDGET', 90))):
+                        state = await workflow.ainvoke({'user_input': item['question']},
+                                                       config={'configurable': {'thread_id': thread_id}})
+                    result.update(answer=state.get('llm_response'), cache_status=state.get('cache_status'), error=None)
+                    counts['done'] += 1
+                except Exception as e:
+                    result.update(answer=None, error=f'{type(e).__name__}: {e}')
+                    counts['errors'] += 1
+                    ### The next turns of the thread must not see the question and context of the failed one
+                    await discard_unfinished_turn(workflow, thread_id)
+                result['timings_ms'] = {'total': round((time.perf_counter() - start) * 1000, 3), **node_timings(trace)}
+            output.write(json.dumps(result, ensure_ascii=False) + '\n')
+            output.flush()
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(producer(), *[worker() for _ in range(concurrency)])
+    finally:
+        output.close()
+    return {**counts, 'elapsed_s': round(time.perf_counter() - start, 3)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer the questions of a JSONL file with the agent.')
+    parser.add_argument('input', help='JSONL file, one {"id": ..., "user_input": ...} per line.')
+    parser.add_argument('output', help='JSONL file the answers are appended to.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--window', type=int, default=64, help='Questions embedded per batched request.')
+    parser.add_argument('--question-key', default='user_input')
+    parser.add_argument('--id-key', default='id')
+    parser.add_argument('--semantic-cache', action='store_true', help='Serve near-duplicate questions from the answer cache.')
+    parser.add_argument('--checkpoints', default=None, help='SQLite file of the conversations, <output>.checkpoints.sqlite by default.')
+    args = parser.parse_args()
+
+    from mygraph_v2 import MyAgent
+    agent = MyAgent(use_semantic_cache=args.semantic_cache)
+    ### Never evicted, a resumed run needs the history of every thread
+    workflow = agent.compile_graph(SQLiteSaver(args.checkpoints or args.output + '.checkpoints.sqlite'))
+    summary = asyncio.run(run_batch(agent, workflow, args.input, args.output, args.concurrency, args.window,
+                                    args.question_key, args.id_key))
+    print(json.dumps(summary))
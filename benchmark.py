@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from uuid import uuid4
+
+import httpx
+import numpy as np
+import psutil
+
+import dotenv
+dotenv.load_dotenv()
+
+### Offline end-to-end benchmark of /chat/stream.
+### Starts server.py with the fake backends of fake_backends.py (or targets a running server with --url),
+### drives it with `--concurrency` parallel conversations and reports time to first byte, total latency,
+### requests/sec and the server RSS as JSON, so runs can be compared with each other.
+###
+###   python benchmark.py --requests 200 --concurrency 20 --output bench.json
+
+QUESTIONS = [
+    "Hi!",
+    "What are his skills?",
+    "Where did he study?",
+    "What is he working on right now?",
+    "Tell me about the U-Rankly project.",
+    "Which certifications does he have?",
+    "Is he looking for a job?",
+    "How many years of Python experience does he have?",
+    "What did he do at LASIGE?",
+    "Can he work remotely?",
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'mean': float(np.mean(values)), 'max': float(np.max(values))}
+
+
+def serve(args):
+    import uvicorn
+    import fake_backends
+    fake_backends.install(
+        llm_ttft = args.llm_ttft,
+        llm_tokens_per_second = args.llm_tps,
+        llm_max_tokens = args.llm_tokens,
+        embedding_latency = args.embedding_latency,
+        retriever_latency = args.retriever_latency,
+        error_rate = args.error_rate,
+        hang_rate = args.hang_rate,
+        hang = args.hang,
+    )
+    import server
+    uvicorn.run(server.app, host='127.0.0.1', port=args.port, log_level='warning')
+
+
+def start_server(args, port):
+    command = [
+        sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port),
+        '--llm-ttft', str(args.llm_ttft), '--llm-tps', str(args.llm_tps), '--llm-tokens', str(args.llm_tokens),
+        '--embedding-latency', str(args.embedding_latency), '--retriever-latency', str(args.retriever_latency),
+        '--error-rate', str(args.error_rate), '--hang-rate', str(args.hang_rate), '--hang', str(args.hang),
+    ]
+    env = {
+        **os.environ,
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'benchmark'),
+        'SEMANTIC_CACHE': '1' if args.semantic_cache else '0',
+        ### All the load comes from one client
+        'RATE_LIMIT_PER_MINUTE': os.environ.get('RATE_LIMIT_PER_MINUTE', '0'),
+        'PINECONE_API_KEY': os.environ.get('PINECONE_API_KEY', 'fake'),
+        'LLM_API_KEY': os.environ.get('LLM_API_KEY', 'fake'),
+    }
+    process = subprocess.Popen(command, env=env)
+    deadline = time.time() + args.startup_timeout
+    status = 'no answer'
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        ### The port opens before the agent is built, /ready answers 200 once it can serve
+        try:
+            response = httpx.get(f'http://127.0.0.1:{port}/ready', timeout=1)
+            if response.status_code == 200:
+                return process
+            status = response.text
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'Server did not start in time, last /ready: {status}')
+
+
+async def sample_rss(pid, samples, stop):
+    process = psutil.Process(pid)
+    while not stop.is_set():
+        samples.append(process.memory_info().rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def chat(client, url, secret_key, user_input, thread_id):
+    start = time.perf_counter()
+    ttfb = None
+    size = 0
+    async with client.stream('POST', url, json={'user_input': user_input, 'thread_id': thread_id},
+                             headers={'X-SECRET-KEY': secret_key}) as response:
+        async for chunk in response.aiter_bytes():
+            if chunk and ttfb is None:
+                ttfb = time.perf_counter() - start
+            size += len(chunk)
+    return response.status_code, ttfb, time.perf_counter() - start, size
+
+
+async def run_benchmark(args, url, pid = None):
+    secret_key = os.environ.get('SECRET_KEY', 'benchmark')
+    conversations = max(1, args.requests // args.turns)
+    queue = asyncio.Queue()
+    for i in range(conversations):
+        queue.put_nowait(i)
+    results = []
+
+    async def worker(client):
+        while not queue.empty():
+            conversation = queue.get_nowait()
+            thread_id = str(uuid4())
+            for turn in range(args.turns):
+                question = QUESTIONS[(conversation + turn) % len(QUESTIONS)]
+                try:
+                    results.append(await chat(client, url, secret_key, question, thread_id))
+                except httpx.HTTPError as e:
+                    results.append((type(e).__name__, None, None, 0))
+
+    rss_samples, stop = [], asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(pid, rss_samples, stop)) if pid else None
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        ### Warm-up request, not counted
+        await chat(client, url, secret_key, QUESTIONS[0], str(uuid4()))
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+    if sampler:
+        stop.set()
+        await sampler
+
+    ok = [r for r in results if r[0] == 200]
+    return {
+        'config': vars(args),
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'elapsed_s': elapsed,
+        'requests_per_s': len(ok) / elapsed if elapsed else 0.0,
+        'ttfb_s': percentiles([r[1] for r in ok if r[1] is not None]),
+        'latency_s': percentiles([r[2] for r in ok]),
+        'response_bytes': percentiles([r[3] for r in ok]),
+        'server_rss_mb': {
+            'start': rss_samples[0] / 2**20,
+            'max': max(rss_samples) / 2**20,
+            'end': rss_samples[-1] / 2**20,
+        } if rss_samples else None,
+    }
+
+
+def main(args):
+    process = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        process = start_server(args, port)
+        url = f'http://127.0.0.1:{port}/chat/stream'
+    pid = process.pid if process else args.server_pid
+    try:
+        report = asyncio.run(run_benchmark(args, url, pid))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark /chat/stream against fake LLM, embedding and index backends.')
+    parser.add_argument('mode', nargs='?', choices=['run', 'serve'], default='run')
+    parser.add_argument('--url', default=None, help='Benchmark a running server instead of starting one with the fakes.')
+    parser.add_argument('--server-pid', type=int, default=None, help='PID of the server given with --url, to sample its RSS.')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--turns', type=int, default=1, help='Sequential turns per conversation (thread_id).')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--semantic-cache', action='store_true', help='Keep the semantic answer cache enabled.')
+    parser.add_argument('--llm-ttft', type=float, default=0.3, help='Fake LLM time to first token, in seconds.')
+    parser.add_argument('--llm-tps', type=float, default=200.0, help='Fake LLM tokens per second.')
+    parser.add_argument('--llm-tokens', type=int, default=150, help='Fake LLM tokens per answer.')
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--retriever-latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of the fake upstream calls failing.')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='Fraction of the fake upstream calls hanging.')
+    parser.add_argument('--hang', type=float, default=30.0, help='Seconds a hanging fake upstream call takes.')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file.')
+    args = parser.parse_args()
+    if args.mode == 'serve':
+        serve(args)
+    else:
+        main(args)
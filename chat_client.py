@@ -0,0 +1,90 @@
+import codecs
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+### Streaming client of /chat/stream used by the Streamlit front end.
+### One pooled session is shared by every user of the app, the answer is decoded as it arrives (a multi-byte
+### character split between two network chunks is held back until it is complete), and `coalesce` turns the
+### token stream into redraws at a fixed rate, so the display keeps up with the server whatever its speed.
+
+
+class ChatClient:
+    def __init__(self, uri, secret_key = None, pool_size = 16, connect_timeout = 5, read_timeout = 120):
+        """
+        Args:
+            uri (str): URL of the /chat/stream endpoint.
+            secret_key (str, optional): Value of the X-SECRET-KEY header.
+            pool_size (int): Connections kept open to the server.
+            connect_timeout (float): Seconds to open a connection.
+            read_timeout (float): Seconds to wait for the next bytes of the answer.
+        """
+        self.uri = uri
+        self.secret_key = secret_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def stream(self, user_input, thread_id, client_id = None, forwarded_for = None):
+        """
+        Yields the text of the answer as it is received. Closing the generator closes the connection,
+        which makes the server stop generating.
+
+        Args:
+            client_id (str, optional): X-Client-Id, identifies the caller when the server cannot see its address.
+            forwarded_for (str, optional): X-Forwarded-For received from the user, the server rate limits by the
+                user's address when this app is one of its TRUSTED_PROXIES.
+        """
+        headers = {"Content-Type": "application/json", "X-SECRET-KEY": self.secret_key or ''}
+        if client_id:
+            headers["X-Client-Id"] = client_id
+        if forwarded_for:
+            headers["X-Forwarded-For"] = forwarded_for
+        payload = {"user_input": user_input, "thread_id": thread_id}
+        with self.session.post(self.uri, json=payload, headers=headers, stream=True, timeout=self.timeout) as res:
+            if res.status_code != 200:
+                yield self.error_message(res)
+                return
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            ### chunk_size=None yields the bytes as soon as they arrive instead of waiting for a fixed size
+            for chunk in res.iter_content(chunk_size=None):
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+            text = decoder.decode(b'', final=True)
+            if text:
+                yield text
+
+    @staticmethod
+    def error_message(res):
+        if res.status_code in (429, 503):
+            retry_after = res.headers.get('Retry-After')
+            wait = f" Please try again in {retry_after} s." if retry_after else " Please try again shortly."
+            return "I'm receiving too many messages right now." + wait
+        try:
+            detail = res.json().get('detail', res.reason)
+        except ValueError:
+            detail = res.reason
+        return f"Error {res.status_code}: {detail}"
+
+
+def coalesce(chunks, interval = 0.05):
+    """
+    Yields the text received so far at most once every `interval` seconds, and once more at the end.
+    """
+    text = ''
+    last = 0.0
+    pending = False
+    for chunk in chunks:
+        text += chunk
+        pending = True
+        now = time.monotonic()
+        if now - last >= interval:
+            last = now
+            pending = False
+            yield text
+    if pending:
+        yield text
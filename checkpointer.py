@@ -0,0 +1,422 @@
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.serde.types import TASKS
+
+import dotenv
+dotenv.load_dotenv()
+
+### Checkpointers used by `MyAgent.compile_graph`.
+### Both keep only the last few checkpoints of a thread (the graph never travels back further than that)
+### and evict idle threads, so the footprint stays flat no matter how many conversations the server sees.
+
+
+def get_next_version(current, channel):
+    if current is None:
+        current_v = 0
+    elif isinstance(current, int):
+        current_v = current
+    else:
+        current_v = int(current.split(".")[0])
+    return f"{current_v + 1:032}.{random.random():016}"
+
+
+class BoundedMemorySaver(MemorySaver):
+    def __init__(self, max_threads = None, ttl = None, max_bytes = None, keep_last = 2, serde = None):
+        """
+        In-memory checkpointer with LRU / TTL eviction of idle threads and a memory cap.
+
+        Args:
+            max_threads (int, optional): Maximum number of threads kept, the least recently used are evicted first.
+            ttl (float, optional): Seconds of inactivity after which a thread is evicted.
+            max_bytes (int, optional): Cap on the serialized size of all the stored checkpoints and writes.
+            keep_last (int, optional): Checkpoints kept per thread, older ones are pruned. None keeps all of them.
+        """
+        super().__init__(serde=serde)
+        self.max_threads = max_threads
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.keep_last = keep_last
+        self.last_access = OrderedDict()
+        self.thread_bytes = {}
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            if thread_id not in self.storage:
+                return None
+            self.touch(thread_id)
+            return super().get_tuple(config)
+
+    def list(self, config, *, filter = None, before = None, limit = None):
+        with self.lock:
+            if config and config["configurable"]["thread_id"] not in self.storage:
+                return iter(())
+            return iter(list(super().list(config, filter=filter, before=before, limit=limit)))
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            self.prune(thread_id, config["configurable"]["checkpoint_ns"])
+            self.update_size(thread_id)
+            self.touch(thread_id)
+            self.evict()
+            return next_config
+
+    def put_writes(self, config, writes, task_id, task_path = ""):
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            super().put_writes(config, writes, task_id, task_path)
+            self.update_size(thread_id)
+            self.touch(thread_id)
+            self.evict()
+
+    def get_next_version(self, current, channel):
+        return get_next_version(current, channel)
+
+    def touch(self, thread_id):
+        self.last_access[thread_id] = time.monotonic()
+        self.last_access.move_to_end(thread_id)
+
+    def prune(self, thread_id, checkpoint_ns):
+        if self.keep_last is None:
+            return
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        for checkpoint_id in sorted(checkpoints)[:-self.keep_last]:
+            del checkpoints[checkpoint_id]
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+    def update_size(self, thread_id):
+        size = 0
+        for checkpoint_ns, checkpoints in self.storage[thread_id].items():
+            for checkpoint_id, (checkpoint, metadata, _) in checkpoints.items():
+                size += len(checkpoint[1]) + len(metadata[1])
+                for write in self.writes.get((thread_id, checkpoint_ns, checkpoint_id), {}).values():
+                    size += len(write[2][1])
+        self.total_bytes += size - self.thread_bytes.get(thread_id, 0)
+        self.thread_bytes[thread_id] = size
+
+    def evict(self):
+        if self.ttl is not None:
+            deadline = time.monotonic() - self.ttl
+            while self.last_access and next(iter(self.last_access.values())) < deadline:
+                self.delete_thread(next(iter(self.last_access)))
+        ### The most recently used thread is never evicted, it is the one being written right now
+        while len(self.last_access) > 1 and (
+            (self.max_threads is not None and len(self.last_access) > self.max_threads)
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            self.delete_thread(next(iter(self.last_access)))
+
+    def delete_thread(self, thread_id):
+        with self.lock:
+            for checkpoint_ns, checkpoints in self.storage.pop(thread_id, {}).items():
+                for checkpoint_id in checkpoints:
+                    self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            self.total_bytes -= self.thread_bytes.pop(thread_id, 0)
+            self.last_access.pop(thread_id, None)
+
+
+class SQLiteSaver(BaseCheckpointSaver[str]):
+    def __init__(self, path = 'checkpoints.sqlite', max_threads = None, ttl = None, keep_last = 2,
+                 evict_interval = 60, serde = None):
+        """
+        Persistent checkpointer backed by a local SQLite file (WAL mode), conversations survive restarts.
+        Several processes can share the same file, e.g. the workers started by launcher.py, each opens its own
+        connection and the write transactions take the lock up front (BEGIN IMMEDIATE) and wait for each other.
+
+        Args:
+            path (str): Path of the database file.
+            max_threads (int, optional): Maximum number of threads kept, the least recently used are evicted first.
+            ttl (float, optional): Seconds of inactivity after which a thread is evicted.
+            keep_last (int, optional): Checkpoints kept per thread, older ones are pruned. None keeps all of them.
+            evict_interval (float): Minimum number of seconds between two eviction passes.
+        """
+        super().__init__(serde=serde)
+        self.path = path
+        self.max_threads = max_threads
+        self.ttl = ttl
+        self.keep_last = keep_last
+        self.evict_interval = evict_interval
+        self.last_eviction = 0.0
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                type TEXT,
+                checkpoint BLOB,
+                metadata_type TEXT,
+                metadata BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+            );
+            CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT,
+                value BLOB,
+                task_path TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS threads (
+                thread_id TEXT PRIMARY KEY,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS threads_last_access ON threads (last_access);
+        ''')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    ### Reads
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        with self.lock:
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self.conn.execute(
+                    'SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints '
+                    'WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?',
+                    (thread_id, checkpoint_ns, checkpoint_id)
+                ).fetchone()
+            else:
+                row = self.conn.execute(
+                    'SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints '
+                    'WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC LIMIT 1',
+                    (thread_id, checkpoint_ns)
+                ).fetchone()
+            if row is None:
+                return None
+            self.touch(thread_id)
+            return self.load_tuple(thread_id, checkpoint_ns, row)
+
+    def list(self, config, *, filter = None, before = None, limit = None):
+        query = 'SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints'
+        clauses, params = [], []
+        if config:
+            clauses.append('thread_id = ?')
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                clauses.append('checkpoint_ns = ?')
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                clauses.append('checkpoint_id = ?')
+                params.append(checkpoint_id)
+        if before and (before_checkpoint_id := get_checkpoint_id(before)):
+            clauses.append('checkpoint_id < ?')
+            params.append(before_checkpoint_id)
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY thread_id, checkpoint_ns, checkpoint_id DESC'
+
+        results = []
+        with self.lock:
+            for thread_id, checkpoint_ns, *row in self.conn.execute(query, params).fetchall():
+                if limit is not None and len(results) >= limit:
+                    break
+                metadata = self.serde.loads_typed((row[4], row[5]))
+                if filter and not all(metadata.get(key) == value for key, value in filter.items()):
+                    continue
+                results.append(self.load_tuple(thread_id, checkpoint_ns, row))
+        return iter(results)
+
+    def load_tuple(self, thread_id, checkpoint_ns, row):
+        checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        writes = self.conn.execute(
+            'SELECT task_id, channel, type, value FROM writes '
+            'WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx',
+            (thread_id, checkpoint_ns, checkpoint_id)
+        ).fetchall()
+        sends = []
+        if parent_checkpoint_id:
+            sends = self.conn.execute(
+                'SELECT type, value FROM writes '
+                'WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? AND channel = ? '
+                'ORDER BY task_path, task_id, idx',
+                (thread_id, checkpoint_ns, parent_checkpoint_id, TASKS)
+            ).fetchall()
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint={
+                **self.serde.loads_typed((type_, checkpoint)),
+                "pending_sends": [self.serde.loads_typed(send) for send in sends],
+            },
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((w_type, value))) for task_id, channel, w_type, value in writes
+            ],
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_checkpoint_id,
+                    }
+                }
+                if parent_checkpoint_id
+                else None
+            ),
+        )
+
+    ### Writes
+    def put(self, config, checkpoint, metadata, new_versions):
+        c = checkpoint.copy()
+        c.pop("pending_sends")
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        type_, serialized_checkpoint = self.serde.dumps_typed(c)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute(
+                'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                 type_, serialized_checkpoint, metadata_type, serialized_metadata)
+            )
+            if self.keep_last is not None:
+                self.prune(thread_id, checkpoint_ns)
+            self.touch(thread_id)
+        self.evict()
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(self, config, writes, task_id, task_path = ""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            w_type, serialized = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx),
+                         channel, w_type, serialized, task_path))
+        ### Regular writes are kept once per task, special channels (negative idx) are overwritten
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR IGNORE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  [row for row in rows if row[4] >= 0])
+            self.conn.executemany('INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  [row for row in rows if row[4] < 0])
+            self.touch(thread_id)
+
+    def get_next_version(self, current, channel):
+        return get_next_version(current, channel)
+
+    ### Async versions, sqlite calls run in a worker thread so they never block the event loop
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter = None, before = None, limit = None):
+        results = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in results:
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path = ""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    ### Eviction
+    def touch(self, thread_id):
+        self.conn.execute('INSERT OR REPLACE INTO threads VALUES (?, ?)', (thread_id, time.time()))
+
+    def prune(self, thread_id, checkpoint_ns):
+        kept = 'SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC LIMIT ?'
+        params = (thread_id, checkpoint_ns, thread_id, checkpoint_ns, self.keep_last)
+        self.conn.execute(f'DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ({kept})', params)
+        self.conn.execute(f'DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ({kept})', params)
+
+    def evict(self):
+        now = time.time()
+        if now - self.last_eviction < self.evict_interval:
+            return
+        self.last_eviction = now
+        with self.lock:
+            expired = []
+            if self.ttl is not None:
+                expired += [row[0] for row in self.conn.execute(
+                    'SELECT thread_id FROM threads WHERE last_access < ?', (now - self.ttl,))]
+            if self.max_threads is not None:
+                expired += [row[0] for row in self.conn.execute(
+                    'SELECT thread_id FROM threads ORDER BY last_access DESC LIMIT -1 OFFSET ?', (self.max_threads,))]
+            for thread_id in set(expired):
+                self.delete_thread(thread_id)
+
+    def delete_thread(self, thread_id):
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            for table in ('writes', 'checkpoints', 'threads'):
+                self.conn.execute(f'DELETE FROM {table} WHERE thread_id = ?', (thread_id,))
+
+
+async def discard_unfinished_turn(workflow, thread_id: str):
+    """
+    Removes the messages of a turn cancelled or failed before its answer was saved, so the history of the
+    thread still ends with an answer and the next turn starts from a consistent checkpoint.
+    """
+    from langchain_core.messages import AIMessage, RemoveMessage
+    config = {'configurable': {'thread_id': thread_id}}
+    snapshot = await workflow.aget_state(config)
+    unanswered = []
+    for message in reversed(snapshot.values.get('chat_history', [])[1:]):
+        if isinstance(message, AIMessage):
+            break
+        unanswered.append(message)
+    if unanswered or snapshot.next:
+        await workflow.aupdate_state(config, {'chat_history': [RemoveMessage(id=message.id) for message in unanswered]},
+                                     as_node='update_cache')
+
+
+def get_checkpointer(backend = None):
+    """
+    Builds the checkpointer selected by the CHECKPOINTER env variable ('memory' or 'sqlite').
+    Limits are read from CHECKPOINT_MAX_THREADS, CHECKPOINT_TTL (seconds), CHECKPOINT_MAX_BYTES (memory only)
+    and the database location from CHECKPOINT_PATH (sqlite only).
+    """
+    backend = backend or os.environ.get('CHECKPOINTER', 'memory')
+    max_threads = int(os.environ.get('CHECKPOINT_MAX_THREADS', 1000))
+    ttl = float(os.environ.get('CHECKPOINT_TTL', 6 * 60 * 60))
+    if backend == 'memory':
+        max_bytes = int(os.environ.get('CHECKPOINT_MAX_BYTES', 256 * 1024 * 1024))
+        return BoundedMemorySaver(max_threads=max_threads, ttl=ttl, max_bytes=max_bytes)
+    if backend == 'sqlite':
+        path = os.environ.get('CHECKPOINT_PATH', 'checkpoints.sqlite')
+        return SQLiteSaver(path, max_threads=max_threads, ttl=ttl)
+    raise ValueError(f"Unknown checkpointer backend: {backend}")
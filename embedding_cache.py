@@ -0,0 +1,91 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+### Content addressed cache for embeddings.
+### Vectors are keyed by a hash of the model url and the normalized text, kept in an in-process LRU
+### and optionally on disk as one compact .npy array per key, so the same question is embedded only once.
+
+
+class EmbeddingCache:
+    def __init__(self, max_size = 4096, cache_dir = None, dtype = 'float32', lowercase = True):
+        """
+        Args:
+            max_size (int): Number of vectors kept in memory.
+            cache_dir (str, optional): Directory of the on-disk store, disabled when None.
+            dtype (str): 'float32' or 'float16', precision of the vectors stored on disk.
+            lowercase (bool): Case-fold the text before hashing. Safe for uncased models like bge-*-en.
+        """
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.dtype = np.dtype(dtype)
+        self.lowercase = lowercase
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, model, text):
+        text = ' '.join(text.split())
+        if self.lowercase:
+            text = text.lower()
+        return hashlib.sha256(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def get(self, model, text):
+        key = self.key(model, text)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key].tolist()
+
+        if self.cache_dir and os.path.exists(path := self.path(key)):
+            vector = np.load(path).astype(np.float32)
+            with self.lock:
+                self.hits += 1
+                self.disk_hits += 1
+                self.add_to_memory(key, vector)
+            return vector.tolist()
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, model, text, embedding):
+        key = self.key(model, text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            self.add_to_memory(key, vector)
+        if self.cache_dir:
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            ### Write then rename, so a concurrent reader never loads a partial file
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, vector.astype(self.dtype))
+            os.replace(tmp_path, path)
+
+    def add_to_memory(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self.memory),
+        }
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import random
+import time
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.retrievers import BaseRetriever
+
+from local_index import split_paragraphs
+from resilience import get_upstream
+
+### Deterministic local stand-ins for Groq, Pinecone and the HF Space, with injected latency and faults.
+### Used by benchmark.py to measure the server without any network call, and how it copes with failing upstreams.
+
+ANSWER = ("Muhammed Jaabir is a data scientist with a strong background in machine learning, "
+          "he is proficient in Python and has worked on several research projects. ")
+
+
+class FakeUpstreamError(Exception):
+    status_code = 503
+
+
+class Faults:
+    def __init__(self, error_rate = 0.0, hang_rate = 0.0, hang = 30.0, seed = None):
+        """
+        Args:
+            error_rate (float): Fraction of the calls failing right away with a 503.
+            hang_rate (float): Fraction of the calls hanging for `hang` seconds, or until their timeout.
+            hang (float): Seconds a hanging call takes.
+            seed (int, optional): Seed of the draws, for reproducible runs.
+        """
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.random = random.Random(seed)
+
+    def draw(self, timeout):
+        ### Returns the seconds to hang, like a client would hang until its timeout then raise
+        value = self.random.random()
+        if value < self.error_rate:
+            raise FakeUpstreamError('Injected upstream error')
+        if value < self.error_rate + self.hang_rate:
+            return self.hang if timeout is None else min(self.hang, timeout)
+        return 0.0
+
+    def check(self, timeout = None):
+        if hang := self.draw(timeout):
+            time.sleep(hang)
+            if hang < self.hang:
+                raise TimeoutError('Injected upstream timeout')
+
+    async def acheck(self, timeout = None):
+        if hang := self.draw(timeout):
+            await asyncio.sleep(hang)
+            if hang < self.hang:
+                raise TimeoutError('Injected upstream timeout')
+
+
+class FakeChatModel(BaseChatModel):
+    ttft: float = 0.3
+    tokens_per_second: float = 200.0
+    max_tokens: int = 150
+    faults: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-chat'
+
+    def tokens(self):
+        words = (ANSWER * (self.max_tokens // len(ANSWER.split()) + 1)).split(' ')
+        return [word + ' ' for word in words[:self.max_tokens]]
+
+    def _generate(self, messages, stop = None, run_manager = None, **kwargs: Any) -> ChatResult:
+        if self.faults:
+            self.faults.check(kwargs.get('timeout'))
+        time.sleep(self.ttft + self.max_tokens / self.tokens_per_second)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(''.join(self.tokens())))])
+
+    def _stream(self, messages, stop = None, run_manager = None, **kwargs: Any):
+        if self.faults:
+            self.faults.check(kwargs.get('timeout'))
+        time.sleep(self.ttft)
+        for token in self.tokens():
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            time.sleep(1 / self.tokens_per_second)
+
+    async def _astream(self, messages, stop = None, run_manager = None, **kwargs: Any):
+        if self.faults:
+            await self.faults.acheck(kwargs.get('timeout'))
+        await asyncio.sleep(self.ttft)
+        for token in self.tokens():
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            await asyncio.sleep(1 / self.tokens_per_second)
+
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self, latency = 0.05, size = 1024, faults = None):
+        self.latency = latency
+        self.size = size
+        self.faults = faults
+        ### Called through the same upstream as the Space client
+        self.upstream = get_upstream('embedding', timeout=10.0)
+
+    def vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:4], 'little')
+        return np.random.default_rng(seed).standard_normal(self.size).astype(np.float32).tolist()
+
+    def call(self, timeout):
+        if self.faults:
+            self.faults.check(timeout)
+        time.sleep(self.latency)
+
+    async def acall(self, timeout):
+        if self.faults:
+            await self.faults.acheck(timeout)
+        await asyncio.sleep(self.latency)
+
+    def embed_documents(self, texts):
+        self.upstream.call(self.call)
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text):
+        self.upstream.call(self.call)
+        return self.vector(text)
+
+    async def aembed_documents(self, texts):
+        await self.upstream.acall(self.acall)
+        return [self.vector(text) for text in texts]
+
+    async def aembed_query(self, text):
+        await self.upstream.acall(self.acall)
+        return self.vector(text)
+
+
+class FakeRetriever(BaseRetriever):
+    chunks: list
+    latency: float = 0.05
+    k: int = 3
+    faults: Any = None
+
+    def select(self, query):
+        start = int(hashlib.sha256(query.encode('utf-8')).hexdigest(), 16) % len(self.chunks)
+        return [Document(self.chunks[(start + i) % len(self.chunks)]) for i in range(min(self.k, len(self.chunks)))]
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        if self.faults:
+            self.faults.check()
+        time.sleep(self.latency)
+        return self.select(query)
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        if self.faults:
+            await self.faults.acheck()
+        await asyncio.sleep(self.latency)
+        return self.select(query)
+
+
+class FakeEncoding:
+    ### Roughly one token per 4 characters, like the tiktoken encodings on English text
+    def encode(self, text):
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+def install(llm_ttft = 0.3, llm_tokens_per_second = 200.0, llm_max_tokens = 150,
+            embedding_latency = 0.05, retriever_latency = 0.05, source_path = 'cleaned_resume.txt',
+            error_rate = 0.0, hang_rate = 0.0, hang = 30.0, seed = None):
+    """
+    Replaces the model and index loaders of mygraph_v2 with the fakes, call it before building `MyAgent`.
+    `error_rate`, `hang_rate` and `hang` inject the same faults in the three backends (see `Faults`).
+    The token counter of the history is replaced too, so nothing is downloaded.
+    """
+    import history
+    import mygraph_v2
+    history.load_encoding = lambda name: FakeEncoding()
+    with open(source_path, 'r', encoding='utf-8') as f:
+        chunks = split_paragraphs(f.read())
+    def faults(offset):
+        if not (error_rate or hang_rate):
+            return None
+        return Faults(error_rate, hang_rate, hang, None if seed is None else seed + offset)
+    mygraph_v2.load_llm_from_huggingface = lambda model_name, max_tokens = 1000: FakeChatModel(
+        ttft=llm_ttft, tokens_per_second=llm_tokens_per_second, max_tokens=min(llm_max_tokens, max_tokens), faults=faults(0))
+    mygraph_v2.load_embedding_model = lambda embedding_model_name: FakeEmbeddings(latency=embedding_latency, faults=faults(1))
+    mygraph_v2.get_retriver_from_pc = lambda index_name, embedding_model, top_k: FakeRetriever(
+        chunks=chunks, latency=retriever_latency, k=top_k, faults=faults(2))
@@ -0,0 +1,88 @@
+from functools import lru_cache
+
+import tiktoken
+from langchain_core.messages import HumanMessage, SystemMessage, RemoveMessage, get_buffer_string
+from langgraph.constants import TAG_NOSTREAM
+
+SUMMARY_PROMPT = '''Progressively summarize the conversation between a user and an AI assistant.
+Extend the current summary with the new lines of the conversation and return only the new summary.
+Keep the names, facts and questions that could be referred to later, drop greetings and small talk.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{conversation}
+
+New summary:'''
+
+
+def load_encoding(name):
+    ### tiktoken downloads the encoding on first use, the fakes replace it to run offline
+    return tiktoken.get_encoding(name)
+
+
+class HistoryManager:
+    def __init__(self, summarizer, max_tokens = 6000, target_ratio = 0.75, encoding = 'cl100k_base'):
+        """
+        Keeps the prompt sent to the LLM under a token budget.
+        When the system message, the summary and the chat history go over `max_tokens`, the oldest turns are
+        folded into a rolling summary until the prompt is back under `max_tokens * target_ratio`, so the
+        summary is only extended every few turns instead of being recomputed on each one.
+
+        Args:
+            summarizer: Runnable (LLM and output parser) returning the extended summary as a string.
+            max_tokens (int): Token budget of the prompt.
+            target_ratio (float): Fraction of the budget the prompt is brought back to when it overflows.
+            encoding (str): tiktoken encoding used to count the tokens.
+        """
+        self.summarizer = summarizer.with_config(tags=[TAG_NOSTREAM])
+        self.max_tokens = max_tokens
+        self.target_ratio = target_ratio
+        self.encoding = load_encoding(encoding)
+        self.count_text = lru_cache(maxsize=4096)(self.count_text)
+
+    def count_text(self, text):
+        return len(self.encoding.encode(text))
+
+    def count_tokens(self, message):
+        ### +4 for the role and separators every chat template adds around a message
+        return self.count_text(message.content) + 4
+
+    def split(self, messages, summary = '', system_tokens = None):
+        """
+        Returns the messages to fold into the summary, the system message and the current turn are always kept.
+        Folding stops on a turn boundary, so the kept history always starts with a user message.
+        `system_tokens` is the precomputed count of the system message, counted here when not given.
+        """
+        history = messages[1:]
+        counts = [self.count_tokens(message) for message in history]
+        if system_tokens is None:
+            system_tokens = self.count_tokens(messages[0])
+        total = system_tokens + self.count_text(summary or '') + sum(counts)
+        if total <= self.max_tokens:
+            return []
+
+        target = self.max_tokens * self.target_ratio
+        idx = 0
+        while idx < len(history) - 1 and (total > target or not isinstance(history[idx], HumanMessage)):
+            total -= counts[idx]
+            idx += 1
+        return history[:idx]
+
+    def build_prompt(self, messages, summary = ''):
+        if not summary:
+            return messages
+        return [messages[0], SystemMessage('Summary of the earlier conversation:\n' + summary), *messages[1:]]
+
+    def summary_input(self, summary, folded):
+        return SUMMARY_PROMPT.format(summary=summary or 'No summary yet.', conversation=get_buffer_string(folded))
+
+    def summarize(self, summary, folded):
+        return self.summarizer.invoke(self.summary_input(summary, folded))
+
+    async def asummarize(self, summary, folded):
+        return await self.summarizer.ainvoke(self.summary_input(summary, folded))
+
+    def remove(self, folded):
+        return [RemoveMessage(id=message.id) for message in folded]
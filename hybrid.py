@@ -0,0 +1,97 @@
+import math
+import re
+from collections import Counter
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+### Hybrid lexical + dense retrieval.
+### Dense similarity alone sometimes misses exact terms (course, tool or university names), a BM25 index over
+### the same chunks catches them. The BM25 weight of every (term, chunk) pair is computed once when the index
+### is built, a query is a few dictionary lookups and array additions, with no network call.
+
+TOKEN_PATTERN = re.compile(r'\w[\w+#.\-]*[\w+#]|\w')
+
+
+def tokenize(text):
+    ### Keeps terms like c++, c#, node.js or scikit-learn in one piece
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def reciprocal_rank_fusion(results, top_k, k = 60, weights = None):
+    """
+    Merges ranked document lists, a document scores `weight / (k + rank)` in every list it appears in.
+    Documents with the same text are merged, the first one seen is returned.
+    """
+    scores = {}
+    docs = {}
+    for result, weight in zip(results, weights or [1.0] * len(results)):
+        for rank, doc in enumerate(result, start=1):
+            key = ' '.join(doc.page_content.split())
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [docs[key] for key in best]
+
+
+class BM25Index:
+    def __init__(self, chunks, k1 = 1.5, b = 0.75):
+        """
+        Args:
+            chunks (list[dict]): {'id': ..., 'text': ..., 'metadata': {...}} chunks, as written by ingest.py.
+            k1 (float): Term frequency saturation.
+            b (float): Document length normalization.
+        """
+        self.chunks = chunks
+        docs = [Counter(tokenize(chunk['text'])) for chunk in chunks]
+        lengths = np.array([sum(doc.values()) for doc in docs], dtype=np.float32)
+        avg_length = max(float(lengths.mean()), 1.0) if len(docs) else 1.0
+
+        postings = {}
+        for doc_id, doc in enumerate(docs):
+            norm = k1 * (1 - b + b * lengths[doc_id] / avg_length)
+            for term, tf in doc.items():
+                postings.setdefault(term, []).append((doc_id, tf * (k1 + 1) / (tf + norm)))
+
+        ### term -> (chunk ids, idf * saturated term frequency)
+        self.postings = {}
+        for term, entries in postings.items():
+            idf = math.log(1 + (len(docs) - len(entries) + 0.5) / (len(entries) + 0.5))
+            ids, weights = zip(*entries)
+            self.postings[term] = (np.array(ids, dtype=np.int32), np.array(weights, dtype=np.float32) * idf)
+
+    def search(self, query, k):
+        """
+        Returns the `k` (score, chunk) pairs with the highest BM25 score, chunks sharing no term with the query are left out.
+        """
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term in self.postings:
+                ids, weights = self.postings[term]
+                scores[ids] += weights
+        matches = np.flatnonzero(scores)
+        if len(matches) > k:
+            matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        matches = matches[np.argsort(-scores[matches])]
+        return [(float(scores[i]), self.chunks[i]) for i in matches]
+
+
+class HybridRetriever(BaseRetriever):
+    dense: BaseRetriever
+    lexical: Any
+    k: int = 3
+    lexical_weight: float = 1.0
+
+    def _lexical_documents(self, query):
+        return [Document(chunk['text'], metadata={**chunk.get('metadata', {}), 'bm25_score': score})
+                for score, chunk in self.lexical.search(query, self.k)]
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return reciprocal_rank_fusion([self.dense.invoke(query), self._lexical_documents(query)], self.k,
+                                      weights=[1.0, self.lexical_weight])
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        return reciprocal_rank_fusion([await self.dense.ainvoke(query), self._lexical_documents(query)], self.k,
+                                      weights=[1.0, self.lexical_weight])
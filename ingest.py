@@ -0,0 +1,187 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from local_index import LocalVectorIndex, index_path_for, split_paragraphs
+
+import dotenv
+dotenv.load_dotenv()
+
+### Offline ingestion of the source documents into the retriever index.
+### Chunk ids are content addressed (hash of the embedding model and the chunk text), so a refresh only
+### embeds the chunks that are new or changed and deletes the ones that disappeared.
+###
+###   python ingest.py cleaned_resume.txt --target pinecone --index resume-index-bge
+###   python ingest.py cleaned_resume.txt --target local --quantize
+
+
+def read_sources(patterns):
+    """
+    Yields (path, text) one source file at a time.
+    """
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, 'r', encoding='utf-8') as f:
+                yield path, f.read()
+
+
+def get_splitter(name, chunk_size = 500, chunk_overlap = 50):
+    if name == 'paragraph':
+        return split_paragraphs
+    if name == 'recursive':
+        return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text
+    raise ValueError(f"Unknown splitter: {name}")
+
+
+def make_chunks(source, texts, model):
+    chunks = {}
+    for position, text in enumerate(texts):
+        digest = hashlib.sha256(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+        chunk_id = f'{os.path.basename(source)}-{digest[:24]}'
+        chunks.setdefault(chunk_id, {'id': chunk_id, 'text': text, 'metadata': {'source': os.path.basename(source), 'position': position}})
+    return list(chunks.values())
+
+
+def batched(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class PineconeTarget:
+    def __init__(self, index_name, manifest_path = None, reset = False, adopt_existing = False):
+        """
+        Args:
+            index_name (str): Pinecone index the chunks are upserted into.
+            manifest_path (str, optional): Chunk ids ingested so far per source, <index_name>.manifest.json by default.
+            reset (bool): Delete every vector of the index and start from an empty manifest.
+            adopt_existing (bool): Without a manifest, treat the vectors already in the index as chunks of the
+                first source, they are deleted once its chunks are upserted.
+        """
+        from pinecone import Pinecone
+        self.index = Pinecone(api_key = os.environ['PINECONE_API_KEY']).Index(index_name)
+        self.manifest_path = manifest_path or f'{index_name}.manifest.json'
+        self.manifest = {}
+        ### Vectors in the index that no manifest entry accounts for, e.g. written before ingest.py existed,
+        ### only adopted on request
+        self.unmanaged = set()
+        if reset:
+            self.index.delete(delete_all=True)
+        elif os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        elif adopt_existing:
+            self.unmanaged = self.list_ids()
+        else:
+            ### Never deleted implicitly, the index may hold the vectors of sources ingested from another checkout
+            count = self.index.describe_index_stats().get('total_vector_count', 0)
+            if count:
+                print(f'No manifest, the {count} vectors already in {index_name} are kept. Run with --adopt-existing '
+                      f'to replace them with the chunks of the first source, or with --reset to clear the index')
+
+    def list_ids(self):
+        ### Listing only works on serverless indexes, a pod based index has to be cleaned with --reset
+        try:
+            return {id for page in self.index.list() for id in page}
+        except Exception as e:
+            print(f'Could not list the ids of the index ({type(e).__name__}), its vectors are kept, '
+                  f'run with --reset to remove them')
+            return set()
+
+    def known_ids(self, source):
+        ### The unmanaged vectors are replaced by the chunks of the first source, then deleted
+        return set(self.manifest.get(source, [])) | self.unmanaged
+
+    def upsert(self, source, chunks, vectors):
+        ### `text` is the metadata key PineconeVectorStore reads the page content from
+        self.index.upsert(vectors=[
+            {'id': chunk['id'], 'values': vector, 'metadata': {**chunk['metadata'], 'text': chunk['text']}}
+            for chunk, vector in zip(chunks, vectors)
+        ])
+
+    def finish(self, source, chunks, stale_ids):
+        for ids in batched(sorted(stale_ids), 1000):
+            self.index.delete(ids=ids)
+        self.unmanaged = set()
+        self.manifest[source] = [chunk['id'] for chunk in chunks]
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+
+class LocalTarget:
+    def __init__(self, quantize = False):
+        self.quantize = quantize
+        self.existing = {}
+        self.new_vectors = {}
+        self.current = None
+
+    def known_ids(self, source):
+        path = index_path_for(source)
+        self.existing, self.new_vectors, self.current = {}, {}, None
+        if not os.path.exists(path):
+            return set()
+        index = LocalVectorIndex.load(path, mmap=False)
+        self.current = (index.chunks, index.scales is not None)
+        for row, chunk in enumerate(index.chunks):
+            if 'id' in chunk:
+                vector = index.vectors[row].astype(np.float32)
+                self.existing[chunk['id']] = vector * index.scales[row] if index.scales is not None else vector
+        return set(self.existing)
+
+    def upsert(self, source, chunks, vectors):
+        for chunk, vector in zip(chunks, vectors):
+            self.new_vectors[chunk['id']] = vector
+
+    def finish(self, source, chunks, stale_ids):
+        ### Left untouched when nothing changed, so the readers watching the index files see no update
+        if self.current == (chunks, self.quantize):
+            return
+        vectors = [self.new_vectors.get(chunk['id'], self.existing.get(chunk['id'])) for chunk in chunks]
+        index = LocalVectorIndex.from_embeddings(vectors, chunks, self.quantize)
+        index.save(index_path_for(source))
+
+
+def ingest(patterns, target, embedding_model, splitter, batch_size = 32):
+    model = getattr(embedding_model, 'space_url', None) or getattr(embedding_model, 'model_id', type(embedding_model).__name__)
+    for source, text in read_sources(patterns):
+        start = time.perf_counter()
+        chunks = make_chunks(source, splitter(text), model)
+        known = target.known_ids(source)
+        new_chunks = [chunk for chunk in chunks if chunk['id'] not in known]
+        stale_ids = known - {chunk['id'] for chunk in chunks}
+
+        for batch in batched(new_chunks, batch_size):
+            target.upsert(source, batch, embedding_model.embed_documents([chunk['text'] for chunk in batch]))
+        target.finish(source, chunks, stale_ids)
+        print(f'{source}: {len(chunks)} chunks, {len(new_chunks)} embedded, {len(stale_ids)} deleted '
+              f'in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chunk, embed and upsert the source documents into the retriever index.')
+    parser.add_argument('sources', nargs='+', help='Source files or glob patterns.')
+    parser.add_argument('--target', choices=['pinecone', 'local'], default='pinecone')
+    parser.add_argument('--index', default='resume-index-bge', help='Pinecone index name.')
+    parser.add_argument('--manifest', default=None, help='Manifest of the ingested chunk ids (pinecone target).')
+    parser.add_argument('--reset', action='store_true', help='Delete every vector of the index first (pinecone target).')
+    parser.add_argument('--adopt-existing', action='store_true',
+                        help='Without a manifest, replace the vectors already in the index (pinecone target).')
+    parser.add_argument('--quantize', action='store_true', help='Store int8 vectors (local target).')
+    parser.add_argument('--splitter', choices=['paragraph', 'recursive'], default='paragraph')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--chunk-overlap', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--embedding-model', default='https://jaaabir-baai-bge-large-en-v1-5.hf.space')
+    args = parser.parse_args()
+
+    from mygraph_v2 import load_embedding_model
+    target = PineconeTarget(args.index, args.manifest, args.reset, args.adopt_existing) if args.target == 'pinecone' else LocalTarget(args.quantize)
+    ingest(args.sources, target, load_embedding_model(args.embedding_model),
+           get_splitter(args.splitter, args.chunk_size, args.chunk_overlap), args.batch_size)
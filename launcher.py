@@ -0,0 +1,50 @@
+import argparse
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+import dotenv
+dotenv.load_dotenv()
+
+### Multi-process launcher of server.py, one uvicorn worker per core by default.
+### The turns of a conversation can land on any worker, so the conversation state goes to the SQLite
+### checkpointer shared by all of them, and the Prometheus metrics are aggregated over the workers.
+### The turns of one conversation still run one at a time, the workers take a lock file of the thread
+### next to the database (see admission.py).
+###
+###   python launcher.py --workers 4 --port 8000
+
+
+def default_workers():
+    return int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+
+
+def prepare_metrics_dir(path):
+    ### Files left by the workers of a previous run would be summed with the new ones
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = path
+
+
+def main(args):
+    if args.workers > 1 and os.environ.get('CHECKPOINTER', 'memory') != 'sqlite':
+        print(f"CHECKPOINTER={os.environ.get('CHECKPOINTER', 'memory')} is per process, using the shared sqlite checkpointer")
+        os.environ['CHECKPOINTER'] = 'sqlite'
+    prepare_metrics_dir(args.metrics_dir)
+    ### The workers inherit the environment and import the app themselves
+    uvicorn.run('server:app', host=args.host, port=args.port, workers=args.workers, log_level=args.log_level,
+                timeout_graceful_shutdown=args.graceful_timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the agent with one worker process per core.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=default_workers(), help='Defaults to WEB_CONCURRENCY or the number of cores.')
+    parser.add_argument('--metrics-dir', default=os.path.join(tempfile.gettempdir(), 'tim-prometheus'))
+    parser.add_argument('--graceful-timeout', type=float, default=30, help='Seconds given to the running streams on shutdown.')
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+    main(args)
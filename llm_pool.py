@@ -0,0 +1,211 @@
+import asyncio
+import time
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream, generate_from_stream
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langgraph.constants import TAG_NOSTREAM
+from resilience import CircuitOpen, UpstreamTimeout, call_with_timeout, get_upstream, remaining
+from metrics import record, LLM_TTFT, LLM_ATTEMPTS, LLM_HEDGES
+
+### Ordered pool of chat backends behind a single chat model.
+### The request goes to the first available backend. If its first token has not arrived after `hedge_delay`
+### seconds, the same request is also sent to the next one, whichever streams first wins and the other is
+### cancelled, so only the slowest few percent of the requests cost a second call. A backend failing before
+### its first token is replaced by the next one right away, and backends with an open circuit are skipped.
+### The attempts run with TAG_NOSTREAM, only the tokens of the winner are streamed, by this model.
+###
+###   LLM_BACKENDS=groq:llama-3.3-70b-versatile,openai:gpt-4o-mini LLM_HEDGE_DELAY=1.5
+
+
+class HedgedChatModel(BaseChatModel):
+    backends: list
+    names: list
+    hedge_delay: float = 1.5
+    max_in_flight: int = 2
+    attempt_config: dict = {'tags': [TAG_NOSTREAM]}
+
+    @property
+    def _llm_type(self) -> str:
+        return 'hedged'
+
+    def upstream(self, i):
+        ### One upstream per backend, the retries are the failover to the next backend
+        return get_upstream(f'llm_{self.names[i]}', timeout=60.0, retries=0)
+
+    def _generate(self, messages, stop = None, run_manager = None, **kwargs):
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    async def _agenerate(self, messages, stop = None, run_manager = None, **kwargs):
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+    def _stream(self, messages, stop = None, run_manager = None, **kwargs):
+        """
+        Failover only, the backends are tried one after the other until one starts answering.
+        """
+        ### The timeout of an attempt comes from its upstream and the request deadline, the clients apply it
+        ### (per request for groq and openai, around the call for the `DeadlineChatModel` ones)
+        kwargs.pop('timeout', None)
+        error = None
+        for i, backend in enumerate(self.backends):
+            upstream = self.upstream(i)
+            try:
+                timeout = upstream.before_call()
+            except CircuitOpen as e:
+                error = e
+                continue
+            started = False
+            try:
+                for chunk in backend.stream(messages, stop=stop, config=self.attempt_config, timeout=timeout, **kwargs):
+                    started = True
+                    yield ChatGenerationChunk(message=chunk)
+            except Exception as e:
+                upstream.failed(e)
+                LLM_ATTEMPTS.labels(self.names[i], 'error').inc()
+                if started:
+                    raise
+                error = e
+                continue
+            except BaseException:
+                ### Closed by the consumer, says nothing about the backend
+                upstream.breaker.release()
+                raise
+            upstream.after_success()
+            LLM_ATTEMPTS.labels(self.names[i], 'won').inc()
+            return
+        raise error
+
+    async def _astream(self, messages, stop = None, run_manager = None, **kwargs):
+        kwargs.pop('timeout', None)
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        candidates = iter(range(len(self.backends)))
+        running = {}
+        ### Attempts whose breaker was already updated, the others are released when the stream is closed
+        settled = set()
+        errors = []
+        start = time.perf_counter()
+
+        async def attempt(i, timeout):
+            async def consume():
+                stream = self.backends[i].astream(messages, stop=stop, config=self.attempt_config, **kwargs)
+                try:
+                    async for chunk in stream:
+                        events.put_nowait((i, 'chunk', chunk))
+                finally:
+                    await stream.aclose()
+            try:
+                await asyncio.wait_for(consume(), timeout)
+                events.put_nowait((i, 'done', None))
+            except asyncio.TimeoutError:
+                events.put_nowait((i, 'error', UpstreamTimeout(f'{self.names[i]} did not answer within {timeout:.2f}s')))
+            except Exception as e:
+                events.put_nowait((i, 'error', e))
+
+        def launch():
+            for i in candidates:
+                try:
+                    timeout = self.upstream(i).before_call()
+                except CircuitOpen as e:
+                    errors.append(e)
+                    continue
+                running[i] = asyncio.create_task(attempt(i, timeout))
+                return True
+            return False
+
+        if not launch():
+            raise errors[-1]
+        hedge_at = loop.time() + self.hedge_delay
+        winner = None
+        try:
+            while True:
+                wait = None
+                if winner is None and self.hedge_delay > 0 and len(running) < self.max_in_flight:
+                    wait = max(0.0, hedge_at - loop.time())
+                try:
+                    i, kind, value = await asyncio.wait_for(events.get(), wait)
+                except asyncio.TimeoutError:
+                    ### First token late, the request is also sent to the next backend
+                    if launch():
+                        LLM_HEDGES.inc()
+                        record('llm_hedge', backend=self.names[max(running)])
+                    hedge_at = loop.time() + self.hedge_delay
+                    continue
+
+                if winner is None:
+                    if kind == 'error':
+                        ### Failover, the failed attempt is replaced by the next backend
+                        del running[i]
+                        self.upstream(i).failed(value)
+                        settled.add(i)
+                        LLM_ATTEMPTS.labels(self.names[i], 'error').inc()
+                        errors.append(value)
+                        if launch():
+                            hedge_at = loop.time() + self.hedge_delay
+                        elif not running:
+                            raise value
+                        continue
+                    winner = i
+                    ttft = time.perf_counter() - start
+                    LLM_TTFT.labels(self.names[i]).observe(ttft)
+                    record('llm_backend', backend=self.names[i], ttft_ms=round(ttft * 1000, 3), attempts=len(running) + len(errors))
+                    for j, task in running.items():
+                        if j != i:
+                            task.cancel()
+                            self.upstream(j).breaker.release()
+                            settled.add(j)
+                            LLM_ATTEMPTS.labels(self.names[j], 'lost').inc()
+
+                if i != winner:
+                    continue
+                if kind == 'chunk':
+                    ### Streamed under the id of this model's run
+                    value.id = None
+                    yield ChatGenerationChunk(message=value)
+                elif kind == 'done':
+                    self.upstream(i).after_success()
+                    settled.add(i)
+                    LLM_ATTEMPTS.labels(self.names[i], 'won').inc()
+                    return
+                else:
+                    self.upstream(i).failed(value)
+                    settled.add(i)
+                    LLM_ATTEMPTS.labels(self.names[i], 'error').inc()
+                    raise value
+        finally:
+            ### Cancelled by the consumer, a half open trial call must not keep its backend excluded
+            for i, task in running.items():
+                task.cancel()
+                if i not in settled:
+                    self.upstream(i).breaker.release()
+            await asyncio.gather(*running.values(), return_exceptions=True)
+
+
+class DeadlineChatModel(BaseChatModel):
+    """
+    Chat model whose client has no per-call timeout option (Mistral, NVIDIA): they copy unknown kwargs into
+    the request body. The `timeout` given by the upstreams is dropped and enforced around the call instead,
+    by `call_with_timeout` for the sync calls and by the `asyncio.wait_for` of `Upstream.acall` for the async ones.
+    """
+    model: Any
+    attempt_config: dict = {'tags': [TAG_NOSTREAM]}
+
+    @property
+    def _llm_type(self) -> str:
+        return f'deadline_{self.model._llm_type}'
+
+    def _generate(self, messages, stop = None, run_manager = None, **kwargs):
+        timeout = kwargs.pop('timeout', None) or remaining()
+        message = call_with_timeout(lambda: self.model.invoke(messages, stop=stop, config=self.attempt_config, **kwargs),
+                                    timeout=timeout)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop = None, run_manager = None, **kwargs):
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+    async def _astream(self, messages, stop = None, run_manager = None, **kwargs):
+        kwargs.pop('timeout', None)
+        async for chunk in self.model.astream(messages, stop=stop, config=self.attempt_config, **kwargs):
+            ### Streamed under the id of this model's run
+            chunk.id = None
+            yield ChatGenerationChunk(message=chunk)
@@ -0,0 +1,135 @@
+import glob
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from typing import Any
+from uuid import uuid4
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+### In-process alternative to the Pinecone index.
+### The whole corpus fits in a small embedding matrix, so a query is a single matrix-vector product
+### instead of a network round trip. The index is saved next to its source text as `<source>.index/`:
+###   vectors.npy  normalized embeddings, float32 or int8 (memory-mapped on load)
+###   scales.npy   per-row scales of the int8 vectors
+###   chunks.json  chunk texts and metadata
+### `<source>.index` is a symlink to the directory of the current version, a new version is written next to it
+### and swapped in with one atomic rename, so readers always see the files of a single version.
+
+
+def index_path_for(source_path):
+    return os.path.splitext(source_path)[0] + '.index'
+
+
+@contextmanager
+def index_lock(path):
+    """
+    Exclusive lock of the index at `path` across processes, e.g. the workers of launcher.py building it at startup.
+    """
+    import fcntl
+    with open(f'{os.path.abspath(path)}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class LocalVectorIndex:
+    def __init__(self, vectors, chunks, scales = None):
+        """
+        Args:
+            vectors (np.ndarray): (n, dim) normalized embeddings, float32 or int8.
+            chunks (list[dict]): One {'id': ..., 'text': ..., 'metadata': {...}} per row of `vectors`.
+            scales (np.ndarray, optional): (n,) scales of the int8 rows, None for float32 vectors.
+        """
+        self.vectors = vectors
+        self.chunks = chunks
+        self.scales = scales
+
+    @classmethod
+    def from_embeddings(cls, embeddings, chunks, quantize = False):
+        vectors = normalize(embeddings)
+        if not quantize:
+            return cls(vectors, chunks)
+        ### Symmetric per-row int8 quantization, 4x smaller with a negligible loss in ranking quality
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+        return cls(np.round(vectors / scales[:, None]).astype(np.int8), chunks, scales.astype(np.float32))
+
+    def search(self, query_embedding, k):
+        """
+        Returns the `k` (score, chunk) pairs with the highest cosine similarity to the query.
+        """
+        if len(self.chunks) == 0:
+            return []
+        query = normalize(query_embedding)
+        scores = self.vectors @ query
+        if self.scales is not None:
+            scores = scores * self.scales
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.chunks[i]) for i in top]
+
+    def save(self, path):
+        path = os.path.abspath(path)
+        version = f'{path}.v-{uuid4().hex[:12]}'
+        os.makedirs(version)
+        np.save(os.path.join(version, 'vectors.npy'), self.vectors)
+        if self.scales is not None:
+            np.save(os.path.join(version, 'scales.npy'), self.scales)
+        with open(os.path.join(version, 'chunks.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.chunks, f, ensure_ascii=False)
+
+        previous = os.path.realpath(path) if os.path.islink(path) else None
+        if os.path.isdir(path) and not os.path.islink(path):
+            ### Index written by an older version of this module, a plain directory
+            shutil.rmtree(path)
+        link = f'{version}.link'
+        os.symlink(os.path.basename(version), link)
+        os.replace(link, path)
+        ### The previous version is kept for the readers still loading it, older ones are removed.
+        ### A process that memory-mapped removed vectors keeps reading them safely.
+        for old in glob.glob(f'{glob.escape(path)}.v-*'):
+            if old not in (version, previous) and not old.endswith('.link'):
+                shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        ### Resolved once, all the files come from the same version
+        path = os.path.realpath(path)
+        vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r' if mmap else None)
+        scales_path = os.path.join(path, 'scales.npy')
+        scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        with open(os.path.join(path, 'chunks.json'), 'r', encoding='utf-8') as f:
+            chunks = json.load(f)
+        return cls(vectors, chunks, scales)
+
+
+class LocalRetriever(BaseRetriever):
+    index: Any
+    embedding: Any
+    k: int = 3
+
+    def _to_documents(self, results):
+        return [Document(chunk['text'], metadata={**chunk.get('metadata', {}), 'score': score}) for score, chunk in results]
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return self._to_documents(self.index.search(self.embedding.embed_query(query), self.k))
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        return self._to_documents(self.index.search(await self.embedding.aembed_query(query), self.k))
+
+
+def split_paragraphs(text):
+    return [paragraph.strip() for paragraph in text.split('\n\n') if paragraph.strip()]
+
@@ -0,0 +1,163 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+import dotenv
+dotenv.load_dotenv()
+
+### Prometheus metrics and per-request traces of the chat pipeline.
+### Durations are recorded in the histograms below and, when a request trace is active, also appended to it
+### as spans. With TRACE_LOG=1 every finished request is logged as one JSON line on the `tim.trace` logger.
+### When PROMETHEUS_MULTIPROC_DIR is set (see launcher.py) the metrics of all the workers are aggregated.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+NODE_DURATION = Histogram('tim_node_duration_seconds', 'Duration of the graph nodes.', ['node'], buckets=LATENCY_BUCKETS)
+NODE_ERRORS = Counter('tim_node_errors_total', 'Graph nodes that raised an exception.', ['node'])
+EMBEDDING_DURATION = Histogram('tim_embedding_request_duration_seconds', 'Duration of the embedding requests.', ['mode'], buckets=LATENCY_BUCKETS)
+EMBEDDING_PAYLOAD = Histogram('tim_embedding_payload_bytes', 'Size of the embedding requests and responses.', ['direction'], buckets=SIZE_BUCKETS)
+CONTEXT_SIZE = Histogram('tim_retriever_context_bytes', 'Size of the retrieved context added to the prompt.', buckets=SIZE_BUCKETS)
+RETRIEVER_QUERIES = Histogram('tim_retriever_queries', 'Search queries fanned out per retrieval.', buckets=(1, 2, 3, 4, 6, 8))
+LLM_TOKENS = Counter('tim_llm_tokens_total', 'Tokens sent to and generated by the LLM.', ['kind'])
+REQUEST_DURATION = Histogram('tim_request_duration_seconds', 'Total duration of the /chat/stream requests.', buckets=LATENCY_BUCKETS)
+REQUEST_TTFB = Histogram('tim_request_ttfb_seconds', 'Time to the first streamed byte of /chat/stream.', buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge('tim_requests_in_flight', 'Requests currently being streamed.', multiprocess_mode='livesum')
+REQUESTS_ABANDONED = Counter('tim_requests_abandoned_total', 'Requests cancelled because the client disconnected.', ['phase'])
+REQUESTS_REJECTED = Counter('tim_requests_rejected_total', 'Requests rejected by the admission control.', ['reason'])
+ADMISSION_WAIT = Histogram('tim_admission_wait_seconds', 'Time requests waited for their thread and a free slot.', buckets=LATENCY_BUCKETS)
+UPSTREAM_CALLS = Counter('tim_upstream_calls_total', 'Calls to the embedding, retriever and LLM upstreams by outcome.', ['upstream', 'outcome'])
+LLM_TTFT = Histogram('tim_llm_ttft_seconds', 'Time to the first token of the winning chat backend.', ['backend'], buckets=LATENCY_BUCKETS)
+LLM_ATTEMPTS = Counter('tim_llm_attempts_total', 'Requests sent to the chat backends by outcome.', ['backend', 'outcome'])
+LLM_HEDGES = Counter('tim_llm_hedges_total', 'Backup LLM requests sent because the first token was late.')
+ROUTER_DECISIONS = Counter('tim_router_decisions_total', 'Model tier picked for the questions, and why.', ['tier', 'reason'])
+LLM_TIER_TTFT = Histogram('tim_llm_tier_ttft_seconds', 'Time to the first token of the LLM, by model tier.', ['tier'], buckets=LATENCY_BUCKETS)
+LLM_TIER_DURATION = Histogram('tim_llm_tier_duration_seconds', 'Duration of the LLM answers, by model tier.', ['tier'], buckets=LATENCY_BUCKETS)
+CIRCUIT_STATE = Gauge('tim_circuit_state', 'Circuit breaker of each upstream, 0 closed, 1 half open, 2 open.', ['upstream'], multiprocess_mode='livemax')
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+trace_logger = logging.getLogger('tim.trace')
+if os.environ.get('TRACE_LOG', '0') == '1':
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.addHandler(logging.StreamHandler())
+    trace_logger.propagate = False
+
+
+def record(name, duration = None, **attrs):
+    """
+    Appends a span to the trace of the current request, if there is one.
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        span = {'name': name, **attrs}
+        if duration is not None:
+            span['duration_ms'] = round(duration * 1000, 3)
+        trace['spans'].append(span)
+
+
+@contextmanager
+def timed(histogram, name, **attrs):
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        duration = time.perf_counter() - start
+        histogram.observe(duration)
+        record(name, duration, **attrs)
+
+
+def instrumented(node):
+    """
+    Decorator timing a graph node, works for both the sync and the async implementations.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with timed(NODE_DURATION.labels(node), f'node:{node}'), count_errors(node):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with timed(NODE_DURATION.labels(node), f'node:{node}'), count_errors(node):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def count_errors(node):
+    try:
+        yield
+    except Exception:
+        NODE_ERRORS.labels(node).inc()
+        raise
+
+
+def record_tokens(prompt_tokens = None, completion_tokens = None):
+    if prompt_tokens is not None:
+        LLM_TOKENS.labels('prompt').inc(prompt_tokens)
+    if completion_tokens is not None:
+        LLM_TOKENS.labels('completion').inc(completion_tokens)
+    record('llm_tokens', prompt=prompt_tokens, completion=completion_tokens)
+
+
+def start_trace(**attrs):
+    trace = {'request_id': str(uuid4()), 'start': time.time(), **attrs, 'spans': []}
+    current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace, **attrs):
+    trace.update(attrs)
+    if trace_logger.isEnabledFor(logging.INFO):
+        trace_logger.info(json.dumps(trace, default=str))
+
+
+class StatsCollector:
+    """
+    Exposes the `stats()` dict of a cache (hits, misses, hit_rate...) as gauges.
+    """
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+
+    def collect(self):
+        for key, value in self.stats().items():
+            yield GaugeMetricFamily(f'tim_{self.name}_{key}', f'{self.name} {key}.', value=value)
+
+
+collectors = {}
+
+def register_stats(name, stats):
+    ### Registering the same name again (e.g. a second `MyAgent`) points the gauges to the new stats
+    if name in collectors:
+        collectors[name].stats = stats
+    else:
+        collectors[name] = StatsCollector(name, stats)
+        REGISTRY.register(collectors[name])
+    return collectors[name]
+
+
+def latest_metrics():
+    """
+    Metrics in the Prometheus text format, summed over the workers in multi-process mode.
+    The cache stats stay per process, they are the ones of the worker answering the scrape.
+    """
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in collectors.values():
+        registry.register(collector)
+    return generate_latest(registry)
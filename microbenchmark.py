@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import json
+import time
+from uuid import uuid4
+
+import dotenv
+dotenv.load_dotenv()
+
+### Micro-benchmark of the Python-side overhead of a request, without any network or model latency.
+### Times the per-request work done before and after the agent reused its chain and system message, then
+### whole graph runs against zero-latency fakes (fake_backends.py), in microseconds per call.
+###
+###   python microbenchmark.py --number 2000 --requests 300
+
+
+def per_call_us(func, number):
+    func()
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
+
+
+async def per_request_us(workflow, requests, turns):
+    start = time.perf_counter()
+    for _ in range(requests // turns):
+        config = {'configurable': {'thread_id': str(uuid4())}}
+        for _ in range(turns):
+            await workflow.ainvoke({'user_input': 'What are his skills?'}, config=config)
+    return (time.perf_counter() - start) / (requests // turns * turns) * 1e6
+
+
+def main(args):
+    import fake_backends
+    fake_backends.install(llm_ttft=0, llm_tokens_per_second=1e9, llm_max_tokens=args.llm_tokens,
+                          embedding_latency=0, retriever_latency=0)
+    from langchain.memory import ConversationBufferMemory
+    from langchain_core.messages import SystemMessage
+    from mygraph_v2 import MyAgent, CleanStrOutputParser
+    from checkpointer import get_checkpointer
+
+    agent = MyAgent(use_semantic_cache=False, use_query_rewrite=False, use_hybrid=False)
+    workflow = agent.compile_graph(get_checkpointer('memory'))
+
+    def system_message_before():
+        memory = ConversationBufferMemory(return_messages=True)
+        memory.chat_memory.add_message(SystemMessage(agent.sys_message))
+        return memory.chat_memory.messages
+
+    def system_tokens_before():
+        ### A fresh string, as after a checkpoint is loaded, the token count cache has to hash the whole prompt
+        return agent.history.count_tokens(SystemMessage(''.join(agent.sys_message)))
+
+    report = {
+        'chain_us': {
+            'before': per_call_us(lambda: agent.llm | CleanStrOutputParser(), args.number),
+            'after': per_call_us(lambda: agent.chain, args.number),
+        },
+        'system_message_us': {
+            'before': per_call_us(system_message_before, args.number),
+            ### Node body only, without the timing decorator the old code did not have
+            'after': per_call_us(lambda: MyAgent.init_sys_message_to_state.__wrapped__(agent, {'chat_history': []}), args.number),
+        },
+        'system_tokens_us': {
+            'before': per_call_us(system_tokens_before, args.number),
+            'after': per_call_us(lambda: agent.system_tokens, args.number),
+        },
+        'graph_request_us': {
+            'first_turn': asyncio.run(per_request_us(workflow, args.requests, 1)),
+            f'{args.turns}_turns': asyncio.run(per_request_us(workflow, args.requests, args.turns)),
+        },
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the per-request Python overhead of the agent.')
+    parser.add_argument('--number', type=int, default=2000, help='Calls per micro measurement.')
+    parser.add_argument('--requests', type=int, default=300, help='Graph runs per measurement.')
+    parser.add_argument('--turns', type=int, default=5, help='Turns per conversation of the multi-turn measurement.')
+    parser.add_argument('--llm-tokens', type=int, default=20, help='Fake LLM tokens per answer.')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file.')
+    args = parser.parse_args()
+    main(args)
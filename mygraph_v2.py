@@ -3,16 +3,29 @@ from typing_extensions import TypedDict
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langchain_core.messages import AnyMessage
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.runnables import RunnableLambda
 from langchain.schema import BaseOutputParser, SystemMessage, AIMessage, HumanMessage
 from langchain_groq import ChatGroq
-from langchain.memory import ConversationBufferMemory
 
 from pinecone import Pinecone
 from langchain_pinecone.vectorstores import PineconeVectorStore
 from space_embedding import HuggingFaceSpaceEmbeddings
+from embedding_cache import EmbeddingCache
+from local_index import LocalVectorIndex, LocalRetriever, index_lock, index_path_for
+from ingest import ingest, get_splitter, make_chunks, read_sources, LocalTarget
+from hybrid import BM25Index, HybridRetriever
+from checkpointer import get_checkpointer
+from history import HistoryManager
+from semantic_cache import SemanticCache
+from query_rewrite import QueryRewriter
+from resilience import ResilientRetriever, get_upstream, resilient
+from llm_pool import DeadlineChatModel, HedgedChatModel
+from router import QueryRouter
+from metrics import instrumented, record, record_tokens, register_stats, CONTEXT_SIZE, RETRIEVER_QUERIES, \
+    LLM_TIER_TTFT, LLM_TIER_DURATION
 
-import os,re
+import os,re,time
+from concurrent.futures import ThreadPoolExecutor
 import dotenv
 
 dotenv.load_dotenv()
@@ -22,25 +35,97 @@ def load_file(fname):
     with open(fname, 'r', encoding='utf-8') as f:
         return f.read()
 
-def get_retriver_from_pc(index_name, embedding_model_name, top_k):
-    pc = Pinecone(api_key = os.environ['PINECONE_API_KEY'])
+def load_embedding_model(embedding_model_name, backend = None):
+    cache = EmbeddingCache(
+        max_size= int(os.environ.get('EMBEDDING_CACHE_SIZE', 4096)),
+        cache_dir= os.environ.get('EMBEDDING_CACHE_DIR'),
+        dtype= os.environ.get('EMBEDDING_CACHE_DTYPE', 'float32')
+    )
+    ### 'space' calls the Hugging Face Space, 'onnx' runs the same model in-process from an exported copy
+    backend = backend or os.environ.get('EMBEDDING_BACKEND', 'space')
+    if backend == 'onnx':
+        from onnx_embedding import OnnxEmbeddings
+        return OnnxEmbeddings(
+            model_dir= os.environ.get('ONNX_MODEL_DIR', 'models/bge-large-en-v1.5'),
+            cache= cache,
+            batch_size= int(os.environ.get('ONNX_BATCH_SIZE', 32)),
+            num_threads= int(os.environ.get('ONNX_THREADS', 0)) or None,
+            quantized= os.environ.get('ONNX_QUANTIZED', '0') == '1'
+        )
     secret_key = os.environ.get('SECRET_KEY')
-    embedding_model = HuggingFaceSpaceEmbeddings(
+    return HuggingFaceSpaceEmbeddings(
         space_url= embedding_model_name,
-        secret_key= secret_key
+        secret_key= secret_key,
+        cache= cache
     )
+
+def get_retriver_from_pc(index_name, embedding_model, top_k, embedding_backend = None):
+    ### `embedding_model` is either an Embeddings instance or the name of the model to load with `embedding_backend`
+    if isinstance(embedding_model, str):
+        embedding_model = load_embedding_model(embedding_model, embedding_backend)
+    pc = Pinecone(api_key = os.environ['PINECONE_API_KEY'])
     vector_store = PineconeVectorStore(index= pc.Index(index_name), embedding = embedding_model )
     return vector_store.as_retriever(search_type="similarity", search_kwargs={'k': top_k})
 
-def load_llm_from_huggingface(model_name):
+def get_local_retriever(source_path, embedding_model, top_k, quantize = False):
+    ### Incremental, only the chunks of an edited source are embedded again and an up to date index is not rewritten
+    index_path = index_path_for(source_path)
+    ### One worker updates the index, the others then find it up to date
+    with index_lock(index_path):
+        ingest([source_path], LocalTarget(quantize), embedding_model, get_splitter('paragraph'))
+    return LocalRetriever(index= LocalVectorIndex.load(index_path), embedding= embedding_model, k= top_k)
+
+def get_lexical_index(source_path, model):
+    chunks = []
+    for source, text in read_sources([source_path]):
+        chunks.extend(make_chunks(source, get_splitter('paragraph')(text), model))
+    return BM25Index(chunks)
+
+def load_llm_from_huggingface(model_name, max_tokens = 1000):
+    ### Timeouts and retries are handled by the 'llm' upstream, see resilience.py
     llm = ChatGroq(model= model_name,
             temperature=0.9,
-            max_tokens=1000,
-            timeout=None,
-            max_retries=2,
+            max_tokens=max_tokens,
+            timeout=float(os.environ.get('LLM_TIMEOUT', 60)),
+            max_retries=0,
             api_key= os.environ['LLM_API_KEY'])
     return llm
 
+def load_chat_model(provider, model_name, max_tokens = 1000):
+    ### The upstreams pass their deadline as a `timeout` kwarg, only the groq and openai clients take it per call
+    if provider == 'groq':
+        return load_llm_from_huggingface(model_name, max_tokens)
+    settings = dict(model= model_name, temperature=0.9, max_tokens=max_tokens)
+    if provider == 'openai':
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(**settings, timeout=float(os.environ.get('LLM_TIMEOUT', 60)), max_retries=0,
+                          api_key= os.environ['OPENAI_API_KEY'])
+    if provider == 'mistral':
+        from langchain_mistralai import ChatMistralAI
+        return DeadlineChatModel(model= ChatMistralAI(**settings, timeout=int(os.environ.get('LLM_TIMEOUT', 60)),
+                                                      max_retries=0, api_key= os.environ['MISTRAL_API_KEY']))
+    if provider == 'nvidia':
+        from langchain_nvidia_ai_endpoints import ChatNVIDIA
+        return DeadlineChatModel(model= ChatNVIDIA(**settings, api_key= os.environ['NVIDIA_API_KEY']))
+    raise ValueError(f'Unknown LLM provider: {provider}')
+
+def load_llm(model_name):
+    ### LLM_BACKENDS lists provider:model in order of preference, more than one is served by a hedged pool
+    specs = [spec.strip().split(':', 1) for spec in os.environ.get('LLM_BACKENDS', f'groq:{model_name}').split(',') if spec.strip()]
+    if len(specs) == 1:
+        return load_chat_model(*specs[0])
+    providers = [provider for provider, _ in specs]
+    return HedgedChatModel(
+        backends = [load_chat_model(provider, model) for provider, model in specs],
+        names = [provider if providers.count(provider) == 1 else f'{provider}_{i}' for i, provider in enumerate(providers)],
+        hedge_delay = float(os.environ.get('LLM_HEDGE_DELAY', 1.5)),
+    )
+
+def load_small_llm():
+    ### Model of the simple questions when the routing is on, fast and with a tight token cap
+    provider, model_name = os.environ.get('SMALL_LLM', 'groq:llama-3.1-8b-instant').split(':', 1)
+    return load_chat_model(provider, model_name, max_tokens = int(os.environ.get('SMALL_LLM_MAX_TOKENS', 256)))
+
 def load_sys_prompt(fname, username, top_k):
     return SystemMessage(load_file(fname).format(name = username, K = top_k))
 
@@ -49,6 +134,9 @@ class State(TypedDict):
     user_input   : str
     chat_history : Annotated[list[AnyMessage], add_messages]
     llm_response : str
+    summary      : str
+    cache_status : str
+    tier         : str
 
 
 class CleanStrOutputParser(BaseOutputParser):
@@ -61,8 +149,57 @@ class CleanStrOutputParser(BaseOutputParser):
             response = re.sub(pattern, '', response if type(response) == rtype else response.content, flags=re.DOTALL)
             return response
 
+class ThinkStreamFilter:
+    """
+    Incremental version of `CleanStrOutputParser.get_clean_output_from_llm` for token streams.
+    Drops the <think>...</think> spans and the newlines as the chunks arrive, only the tail that
+    could still be the start of a tag is held back, so every character is scanned once.
+    Unlike the regex, a <think> span that is never closed is dropped instead of leaked.
+    """
+    open_tag  = '<think>'
+    close_tag = '</think>'
+
+    def __init__(self):
+        self.buffer = ''
+        self.in_think = False
+
+    def feed(self, chunk: str) -> str:
+        text = self.buffer + chunk
+        output = []
+        pos = 0
+        while True:
+            tag = self.close_tag if self.in_think else self.open_tag
+            idx = text.find(tag, pos)
+            if idx == -1:
+                break
+            if not self.in_think:
+                output.append(text[pos:idx])
+            pos = idx + len(tag)
+            self.in_think = not self.in_think
+
+        end = len(text) - self.partial_tag_length(text, pos, tag)
+        if not self.in_think:
+            output.append(text[pos:end])
+        self.buffer = text[end:]
+        return ''.join(output).replace('\n', '')
+
+    def flush(self) -> str:
+        output = '' if self.in_think else self.buffer.replace('\n', '')
+        self.buffer = ''
+        self.in_think = False
+        return output
+
+    @staticmethod
+    def partial_tag_length(text, start, tag):
+        for size in range(min(len(tag) - 1, len(text) - start), 0, -1):
+            if text.endswith(tag[:size]):
+                return size
+        return 0
+
 class MyAgent:
-    def __init__(self, name = 'Muhammed Jaabir', top_k = 3):
+    def __init__(self, name = 'Muhammed Jaabir', top_k = 3, max_prompt_tokens = 6000, retriever_backend = None,
+                 use_semantic_cache = None, use_query_rewrite = None, use_hybrid = None,
+                 use_routing = None):
         
         self.username = name
         self.top_k = top_k
@@ -70,43 +207,307 @@ class MyAgent:
         self.sys_message = load_file('system_prompt.txt').format(name = self.username, K = self.top_k)
         embedding_model_name = 'https://jaaabir-baai-bge-large-en-v1-5.hf.space'
         model_name = "llama-3.3-70b-versatile"
-        self.retriever = get_retriver_from_pc(index_name, embedding_model_name, top_k)
-        self.llm = load_llm_from_huggingface(model_name)
+        if use_routing is None:
+            use_routing = os.environ.get('MODEL_ROUTING', '0') == '1'
+        ### The LLM client is created while the retriever connects to its index
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            llm = pool.submit(load_llm, model_name)
+            small_llm = pool.submit(load_small_llm) if use_routing else None
+            self.embedding_model = load_embedding_model(embedding_model_name)
+            ### 'pinecone' queries the remote index, 'local' searches an in-process index built from the resume
+            retriever_backend = retriever_backend or os.environ.get('RETRIEVER_BACKEND', 'pinecone')
+            if retriever_backend == 'local':
+                quantize = os.environ.get('LOCAL_INDEX_QUANTIZE', '0') == '1'
+                self.retriever = get_local_retriever('cleaned_resume.txt', self.embedding_model, top_k, quantize)
+                index_files = [os.path.join(index_path_for('cleaned_resume.txt'), 'chunks.json')]
+            else:
+                ### The query is embedded through the 'embedding' upstream, this one only covers the search
+                self.retriever = ResilientRetriever(
+                    retriever = get_retriver_from_pc(index_name, self.embedding_model, top_k),
+                    upstream = get_upstream('pinecone', timeout = 15.0),
+                )
+                index_files = [f'{index_name}.manifest.json']
+        self.llm = llm.result()
+        self.llms = {'large': self.llm}
+        if small_llm is not None:
+            self.llms['small'] = small_llm.result()
+
+        ### BM25 over the same chunks, fused with the vector results to catch exact terms
+        if use_hybrid is None:
+            use_hybrid = os.environ.get('HYBRID_RETRIEVAL', '0') == '1'
+        if use_hybrid:
+            if retriever_backend == 'local':
+                lexical_index = BM25Index(self.retriever.index.chunks)
+            else:
+                lexical_index = get_lexical_index('cleaned_resume.txt', embedding_model_name)
+            self.retriever = HybridRetriever(
+                dense = self.retriever,
+                lexical = lexical_index,
+                k = top_k,
+                lexical_weight = float(os.environ.get('HYBRID_LEXICAL_WEIGHT', 1.0)),
+            )
+        ### Built once and shared by every thread, the system message has a fixed id so `add_messages` never mutates it
+        self.chains = {tier: llm | CleanStrOutputParser() for tier, llm in self.llms.items()}
+        self.chain = self.chains['large']
+        self.llm_upstreams = {'large': get_upstream('llm', timeout = 60.0), 'small': get_upstream('llm_small', timeout = 20.0)}
+        self.llm_upstream = self.llm_upstreams['large']
+        self.history = HistoryManager(resilient(self.chain, self.llm_upstream), max_tokens = max_prompt_tokens)
+        self.system_message = SystemMessage(self.sys_message, id = 'system')
+        self.system_tokens = self.history.count_tokens(self.system_message)
+
+        ### Follow-up questions rewritten into standalone queries and fanned out, results merged with RRF
+        if use_query_rewrite is None:
+            use_query_rewrite = os.environ.get('QUERY_REWRITE', '0') == '1'
+        self.query_rewriter = None
+        if use_query_rewrite:
+            self.query_rewriter = QueryRewriter(resilient(self.llm, self.llm_upstream),
+                                                max_queries = int(os.environ.get('QUERY_FANOUT', 3)))
+
+        ### Answers of first questions reused for near-duplicate questions, reset when the prompt or the index change
+        if use_semantic_cache is None:
+            use_semantic_cache = os.environ.get('SEMANTIC_CACHE', '1') == '1'
+        self.semantic_cache = None
+        if use_semantic_cache:
+            self.semantic_cache = SemanticCache(
+                threshold = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.95)),
+                max_size = int(os.environ.get('SEMANTIC_CACHE_SIZE', 1024)),
+                ttl = float(os.environ.get('SEMANTIC_CACHE_TTL', 60 * 60)),
+                watch_paths = ['system_prompt.txt', *index_files],
+                fingerprint = f'{retriever_backend}:{index_name}:{self.sys_message}',
+            )
+            register_stats('semantic_cache', self.semantic_cache.stats)
+        if self.has_embedding_cache():
+            register_stats('embedding_cache', self.embedding_model.cache.stats)
+
+        ### Simple questions answered by the small model, the others by the large one
+        self.router = None
+        if 'small' in self.llms:
+            router_options = dict(
+                margin = float(os.environ.get('ROUTER_MARGIN', 0.0)),
+                max_small_words = int(os.environ.get('ROUTER_MAX_SMALL_WORDS', 25)),
+            )
+            if os.environ.get('ROUTER_EXAMPLES'):
+                self.router = QueryRouter.from_file(self.embedding_model, os.environ['ROUTER_EXAMPLES'], **router_options)
+            else:
+                self.router = QueryRouter(self.embedding_model, **router_options)
 
         self.graph = StateGraph(State)
         self.graph.add_node('init_sys_message', self.init_sys_message_to_state)
-        self.graph.add_node('retriever', self.retriever_node)
-        self.graph.add_node('invoke_llm', self.llm_node)
+        ### Nodes with both a sync and an async implementation, so `astream` never blocks the event loop
+        self.graph.add_node('semantic_cache', RunnableLambda(self.semantic_cache_node, afunc=self.asemantic_cache_node))
+        self.graph.add_node('retriever', RunnableLambda(self.retriever_node, afunc=self.aretriever_node))
+        self.graph.add_node('manage_history', RunnableLambda(self.history_node, afunc=self.ahistory_node))
+        self.graph.add_node('invoke_llm', RunnableLambda(self.llm_node, afunc=self.allm_node))
+        if self.router is not None:
+            self.graph.add_node('route', RunnableLambda(self.route_node, afunc=self.aroute_node))
+        self.graph.add_node('update_cache', RunnableLambda(self.update_cache_node, afunc=self.aupdate_cache_node))
 
         self.graph.set_entry_point('init_sys_message')
-        self.graph.add_edge('init_sys_message', 'retriever')
-        self.graph.add_edge('retriever', 'invoke_llm')
-        self.graph.add_edge('invoke_llm', END)
+        self.graph.add_edge('init_sys_message', 'semantic_cache')
+        if self.router is not None:
+            self.graph.add_conditional_edges('semantic_cache', self.route_semantic_cache, {'retriever': 'route', END: END})
+            self.graph.add_edge('route', 'retriever')
+        else:
+            self.graph.add_conditional_edges('semantic_cache', self.route_semantic_cache, {'retriever': 'retriever', END: END})
+        self.graph.add_edge('retriever', 'manage_history')
+        self.graph.add_edge('manage_history', 'invoke_llm')
+        self.graph.add_edge('invoke_llm', 'update_cache')
+        self.graph.add_edge('update_cache', END)
+
+    def compile_graph(self, checkpointer = None):
+        return self.graph.compile(checkpointer=checkpointer or get_checkpointer())
 
-    def compile_graph(self):
-        return self.graph.compile(checkpointer=MemorySaver())
+    async def warm_up(self, query = 'warm up'):
+        """
+        One dummy retrieval, so the first user does not pay the cold start of the embedding Space and the index.
+        """
+        await self.retriever.ainvoke(query)
+        if self.router is not None:
+            await self.router.afit()
     
     ### Nodes 
+    @instrumented('init_sys_message')
     def init_sys_message_to_state(self, state: State) -> State:
         if not state['chat_history']:
-            memory = ConversationBufferMemory(return_messages=True)
-            memory.chat_memory.add_message(SystemMessage(self.sys_message))
             return {
-                'chat_history' : memory.chat_memory.messages,
+                'chat_history' : [self.system_message],
             }
-        return state
+        return {}
     
+    @instrumented('semantic_cache')
+    def semantic_cache_node(self, state: State) -> State:
+        if not self.is_cacheable(state):
+            return {'cache_status': 'skip'}
+        return self.cached_response(state, self.embedding_model.embed_query(state['user_input']))
+
+    @instrumented('semantic_cache')
+    async def asemantic_cache_node(self, state: State) -> State:
+        if not self.is_cacheable(state):
+            return {'cache_status': 'skip'}
+        return self.cached_response(state, await self.embedding_model.aembed_query(state['user_input']))
+
+    def route_semantic_cache(self, state: State):
+        return END if state['cache_status'] == 'hit' else 'retriever'
+
+    @instrumented('update_cache')
+    def update_cache_node(self, state: State) -> State:
+        ### The query embedding comes from the embedding cache, no second request
+        if state['cache_status'] == 'miss' and state.get('llm_response'):
+            self.semantic_cache.add(self.embedding_model.embed_query(state['user_input']), state['llm_response'])
+        return {}
+
+    @instrumented('update_cache')
+    async def aupdate_cache_node(self, state: State) -> State:
+        if state['cache_status'] == 'miss' and state.get('llm_response'):
+            self.semantic_cache.add(await self.embedding_model.aembed_query(state['user_input']), state['llm_response'])
+        return {}
+
+    @instrumented('route')
+    def route_node(self, state: State) -> State:
+        ### The query embedding is cached, the retriever does not request it again
+        return {'tier': self.router.route(state['user_input'])}
+
+    @instrumented('route')
+    async def aroute_node(self, state: State) -> State:
+        return {'tier': await self.router.aroute(state['user_input'])}
+
+    @instrumented('retriever')
     def retriever_node(self, state: State) -> State:
-        user_query = state['user_input']
-        context = '\n'.join([doc.page_content for doc in self.retriever.invoke(user_query)])
-        user_query = user_query + '\n' + '[CONTEXT FROM VECTOR STORE]' + '\n' + context
+        if self.query_rewriter is None:
+            docs = self.retriever.invoke(state['user_input'])
+            return self.add_context_to_state(state, docs)
+
+        queries = self.query_rewriter.rewrite(state['chat_history'], state.get('summary'), state['user_input'])
+        self.record_queries(queries)
+        if len(queries) > 1 and self.has_embedding_cache():
+            ### One batched request for all the queries, the retriever then reads them from the embedding cache
+            self.embedding_model.embed_documents(queries)
+        docs = self.query_rewriter.fuse(self.retriever.batch(queries), self.top_k)
+        return self.add_context_to_state(state, docs)
+
+    @instrumented('retriever')
+    async def aretriever_node(self, state: State) -> State:
+        if self.query_rewriter is None:
+            docs = await self.retriever.ainvoke(state['user_input'])
+            return self.add_context_to_state(state, docs)
+
+        queries = await self.query_rewriter.arewrite(state['chat_history'], state.get('summary'), state['user_input'])
+        self.record_queries(queries)
+        if len(queries) > 1 and self.has_embedding_cache():
+            await self.embedding_model.aembed_documents(queries)
+        docs = self.query_rewriter.fuse(await self.retriever.abatch(queries), self.top_k)
+        return self.add_context_to_state(state, docs)
+
+    @instrumented('manage_history')
+    def history_node(self, state: State) -> State:
+        summary = state.get('summary', '')
+        folded = self.history.split(state['chat_history'], summary, self.system_tokens)
+        if not folded:
+            return {}
+        return {
+            'summary' : self.history.summarize(summary, folded),
+            'chat_history' : self.history.remove(folded),
+        }
+
+    @instrumented('manage_history')
+    async def ahistory_node(self, state: State) -> State:
+        summary = state.get('summary', '')
+        folded = self.history.split(state['chat_history'], summary, self.system_tokens)
+        if not folded:
+            return {}
+        return {
+            'summary' : await self.history.asummarize(summary, folded),
+            'chat_history' : self.history.remove(folded),
+        }
+
+    @instrumented('invoke_llm')
+    def llm_node(self, state: State) -> State:
+        prompt = self.history.build_prompt(state['chat_history'], state.get('summary'))
+        tier = self.tier_of(state)
+        start = time.perf_counter()
+        response = self.llm_upstreams[tier].call(lambda timeout: self.chains[tier].invoke(prompt, timeout=timeout))
+        self.record_tier(tier, start)
+        self.record_llm_tokens(prompt, response)
+        return self.add_response_to_state(state, response)
+
+    @instrumented('invoke_llm')
+    async def allm_node(self, state: State) -> State:
+        ### Streams from the model so the tokens reach `stream_mode='messages'` as they arrive,
+        ### the cleaned full response is written back to the state once the stream ends
+        prompt = self.history.build_prompt(state['chat_history'], state.get('summary'))
+        tier = self.tier_of(state)
+        chunks = []
+        start = time.perf_counter()
+        first_chunk = None
+
+        async def generate(timeout):
+            nonlocal first_chunk
+            chunks.clear()
+            stream_filter = ThinkStreamFilter()
+            async for chunk in self.llms[tier].astream(prompt, timeout=timeout):
+                if first_chunk is None:
+                    first_chunk = time.perf_counter()
+                chunks.append(stream_filter.feed(chunk.content))
+            chunks.append(stream_filter.flush())
+            return ''.join(chunks)
+
+        ### Retried only while nothing was streamed, a retry after the first token would repeat it to the user
+        response = await self.llm_upstreams[tier].acall(generate, idempotent=lambda: not chunks)
+        self.record_tier(tier, start, first_chunk)
+        self.record_llm_tokens(prompt, response)
+        return self.add_response_to_state(state, response)
+
+    ### Helpers shared by the sync and async nodes
+    def is_cacheable(self, state: State) -> bool:
+        ### Only the first question of a conversation is answered without any prior context
+        return self.semantic_cache is not None and len(state['chat_history']) == 1 and not state.get('summary')
+
+    def cached_response(self, state: State, embedding) -> State:
+        answer = self.semantic_cache.lookup(embedding)
+        if answer is None:
+            return {'cache_status': 'miss'}
+        return {
+            'cache_status' : 'hit',
+            'llm_response' : answer,
+            'chat_history' : [HumanMessage(state['user_input']), AIMessage(answer)],
+        }
+
+    def has_embedding_cache(self) -> bool:
+        return getattr(self.embedding_model, 'cache', None) is not None
+
+    def record_queries(self, queries):
+        RETRIEVER_QUERIES.observe(len(queries))
+        record('retriever_queries', queries=queries)
+
+    def tier_of(self, state: State) -> str:
+        ### The large model answers when the small one is not configured or its circuit is open
+        tier = state.get('tier') or 'large'
+        if tier not in self.llms or not self.llm_upstreams[tier].breaker.available():
+            return 'large'
+        return tier
+
+    def record_tier(self, tier, start, first_chunk = None):
+        duration = time.perf_counter() - start
+        LLM_TIER_DURATION.labels(tier).observe(duration)
+        ttft = None
+        if first_chunk is not None:
+            ttft = round((first_chunk - start) * 1000, 3)
+            LLM_TIER_TTFT.labels(tier).observe(first_chunk - start)
+        record('llm_tier', tier=tier, duration_ms=round(duration * 1000, 3), ttft_ms=ttft)
+
+    def record_llm_tokens(self, prompt, response):
+        ### The system message always comes first, its count is precomputed
+        prompt_tokens = self.system_tokens + sum(self.history.count_tokens(message) for message in prompt[1:])
+        record_tokens(prompt_tokens, self.history.count_text(response or ''))
+
+    def add_context_to_state(self, state: State, docs) -> State:
+        context = '\n'.join([doc.page_content for doc in docs])
+        CONTEXT_SIZE.observe(len(context.encode('utf-8')))
+        user_query = state['user_input'] + '\n' + '[CONTEXT FROM VECTOR STORE]' + '\n' + context
         state['chat_history'].append(HumanMessage(user_query))
         return state
 
-    def llm_node(self, state: State) -> State:
-        chain = self.llm | CleanStrOutputParser()
-        messages = state['chat_history']
-        response = chain.invoke(messages)
+    def add_response_to_state(self, state: State, response) -> State:
         if response:
             state['chat_history'].pop()
             state['chat_history'].append(HumanMessage(state['user_input']))
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import os
+
+import numpy as np
+import onnxruntime as ort
+from tokenizers import Tokenizer
+from langchain_core.embeddings import Embeddings
+from embedding_cache import EmbeddingCache
+from metrics import timed, EMBEDDING_DURATION
+
+### In-process replacement of `HuggingFaceSpaceEmbeddings`, runs BAAI/bge-large-en-v1.5 on CPU with ONNX Runtime.
+### Same model, [CLS] pooling and L2 normalization as the Space, so the query vectors match the existing index.
+### The model directory holds the files written by `export`:
+###   model.onnx       fp32 weights
+###   model_int8.onnx  dynamically quantized weights (optional, ~4x smaller and faster, slightly less exact)
+###   tokenizer.json
+###
+###   python onnx_embedding.py models/bge-large-en-v1.5 --quantize
+
+
+class OnnxEmbeddings(Embeddings):
+    def __init__(self, model_dir: str, model_name: str = 'BAAI/bge-large-en-v1.5', cache: EmbeddingCache = None,
+                 batch_size: int = 32, max_length: int = 512, num_threads: int = None, quantized: bool = False,
+                 max_wait: float = 0.002):
+        """
+        Args:
+            model_dir (str): Directory written by `export`.
+            model_name (str): Name of the exported model, part of the embedding cache keys.
+            cache (EmbeddingCache, optional): Cache checked before running the model.
+            batch_size (int): Maximum number of texts per inference.
+            max_length (int): Texts are truncated to this many tokens.
+            num_threads (int, optional): Threads used by one inference, ONNX Runtime picks the number of cores when None.
+            quantized (bool): Load the int8 weights.
+            max_wait (float): Seconds a concurrent async query waits for others to share its inference.
+        """
+        self.model_id = f"{model_name}:int8" if quantized else model_name
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.inter_op_num_threads = 1
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        model_path = os.path.join(model_dir, 'model_int8.onnx' if quantized else 'model.onnx')
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length)
+        ### Padded to the longest text of each batch, not to max_length
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id('[PAD]') or 0)
+
+        ### Dynamic batching of the async queries, see `aembed_query`
+        self.pending = []
+        self.pending_loop = None
+        self.running = False
+
+    def embed_documents(self, texts):
+        """
+        Generates embeddings for a list of texts.
+        """
+        if type(texts) == str:
+            return self.embed_query(texts)
+        embeddings = self._lookup(texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        ### Texts of similar length batched together, so little compute goes into padding
+        missing.sort(key=lambda i: len(texts[i]))
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            for i, embedding in zip(batch, self._embed([texts[i] for i in batch])):
+                embeddings[i] = embedding
+                self._store(texts[i], embedding)
+        return embeddings
+
+    def embed_query(self, text):
+        """
+        Generates an embedding for a single query.
+        """
+        embedding = self._lookup([text])[0]
+        if embedding is None:
+            embedding = self._embed([text])[0]
+            self._store(text, embedding)
+        return embedding
+
+    async def aembed_documents(self, texts):
+        """
+        Async version of `embed_documents`, the inference runs in a worker thread.
+        """
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text):
+        """
+        Async version of `embed_query`. Queries arriving while an inference runs, or within `max_wait`
+        of each other, are embedded together in one batch.
+        """
+        embedding = self._lookup([text])[0]
+        if embedding is None:
+            loop = asyncio.get_running_loop()
+            if self.pending_loop is not loop:
+                self.pending, self.pending_loop, self.running = [], loop, False
+            future = loop.create_future()
+            self.pending.append((text, future))
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+            elif len(self.pending) == 1:
+                loop.call_later(self.max_wait, self._flush)
+            embedding = await future
+            self._store(text, embedding)
+        return embedding
+
+    ### Dynamic batching
+    def _flush(self):
+        ### A single inference at a time, the queries queued meanwhile make the next batch
+        if self.running or not self.pending:
+            return
+        batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+        self.running = True
+        task = asyncio.ensure_future(asyncio.to_thread(self._embed, [text for text, _ in batch]))
+        task.add_done_callback(lambda task: self._resolve(batch, task))
+
+    def _resolve(self, batch, task):
+        self.running = False
+        error = task.exception()
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(task.result()[i])
+        self._flush()
+
+    ### Cache helpers
+    def _lookup(self, texts):
+        if self.cache is None:
+            return [None] * len(texts)
+        return [self.cache.get(self.model_id, text) for text in texts]
+
+    def _store(self, text, embedding):
+        if self.cache is not None:
+            self.cache.set(self.model_id, text, embedding)
+
+    ### Inference
+    def _embed(self, texts):
+        with timed(EMBEDDING_DURATION.labels('single' if len(texts) == 1 else 'batch'), 'embedding',
+                   mode='onnx', texts=len(texts)):
+            encodings = self.tokenizer.encode_batch(texts)
+            inputs = {
+                'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+                'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64),
+            }
+            hidden = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        ### [CLS] pooling then L2 normalization, as bge does
+        vectors = hidden[:, 0]
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors.tolist()
+
+
+def export(model_name, model_dir, quantize = False):
+    """
+    Exports a Hugging Face model to `model_dir` in the layout read by `OnnxEmbeddings`. Needs torch and transformers.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.backend_tokenizer.save(os.path.join(model_dir, 'tokenizer.json'))
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    sample = tokenizer(['export'], return_tensors='pt')
+    names = ['input_ids', 'attention_mask', 'token_type_ids']
+    axes = {name: {0: 'batch', 1: 'sequence'} for name in names}
+    axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    model_path = os.path.join(model_dir, 'model.onnx')
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in names), model_path, input_names=names,
+                          output_names=['last_hidden_state'], dynamic_axes=axes, opset_version=17)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(model_path, os.path.join(model_dir, 'model_int8.onnx'), weight_type=QuantType.QInt8)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the embedding model to ONNX for OnnxEmbeddings.')
+    parser.add_argument('model_dir')
+    parser.add_argument('--model', default='BAAI/bge-large-en-v1.5')
+    parser.add_argument('--quantize', action='store_true', help='Also write int8 quantized weights.')
+    args = parser.parse_args()
+    export(args.model, args.model_dir, args.quantize)
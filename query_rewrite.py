@@ -0,0 +1,89 @@
+import re
+
+from langchain_core.messages import get_buffer_string
+from langchain_core.output_parsers import StrOutputParser
+from langgraph.constants import TAG_NOSTREAM
+
+from hybrid import reciprocal_rank_fusion
+
+REWRITE_PROMPT = '''You write search queries for a vector store holding the resume of a person.
+Rewrite the latest question of the user as a standalone search query, resolving every pronoun and reference
+with the conversation below. If the question asks about several things, add one short query per thing.
+Return at most {max_queries} queries, one per line, without numbering or any other text.
+
+Summary of the earlier conversation:
+{summary}
+
+Conversation:
+{conversation}
+
+Latest question:
+{question}
+
+Queries:'''
+
+
+class QueryRewriter:
+    def __init__(self, llm, max_queries = 3, history_messages = 6, rrf_k = 60):
+        """
+        Turns the user input into standalone search queries and merges the documents retrieved for each of them.
+
+        Args:
+            llm: Chat model used to rewrite the question, its tokens are not streamed to the client.
+            max_queries (int): Maximum number of queries retrieved concurrently.
+            history_messages (int): Number of the latest chat messages given to the model as context.
+            rrf_k (int): Constant of the reciprocal-rank fusion, higher values flatten the rank weights.
+        """
+        self.chain = (llm | StrOutputParser()).with_config(tags=[TAG_NOSTREAM])
+        self.max_queries = max_queries
+        self.history_messages = history_messages
+        self.rrf_k = rrf_k
+
+    def needs_rewrite(self, messages, summary = ''):
+        ### A first question has nothing to resolve, the model is only called when it can also fan out
+        return len(messages) > 1 or bool(summary) or self.max_queries > 1
+
+    def rewrite_input(self, messages, summary, question):
+        return REWRITE_PROMPT.format(
+            max_queries = self.max_queries,
+            summary = summary or 'No summary yet.',
+            conversation = get_buffer_string(messages[1:][-self.history_messages:]) or 'No conversation yet.',
+            question = question,
+        )
+
+    def parse(self, output, question):
+        output = re.sub(r'<think>.*?</think>', '', output, flags=re.DOTALL)
+        queries = []
+        for line in output.splitlines():
+            query = re.sub(r'^\s*(?:[-*•]|\d+[.)])\s*', '', line).strip().strip('"').strip()
+            if query and query.lower() not in (q.lower() for q in queries):
+                queries.append(query)
+        queries = queries[:self.max_queries]
+        ### The raw question is kept as a fallback list, documents it shares with the rewrites rank higher
+        if question.lower() not in (q.lower() for q in queries):
+            queries.append(question)
+        return queries
+
+    def rewrite(self, messages, summary, question):
+        if not self.needs_rewrite(messages, summary):
+            return [question]
+        try:
+            return self.parse(self.chain.invoke(self.rewrite_input(messages, summary, question)), question)
+        except Exception as e:
+            print(f'Query rewrite failed, retrieving with the raw question: {type(e).__name__}: {e}')
+            return [question]
+
+    async def arewrite(self, messages, summary, question):
+        if not self.needs_rewrite(messages, summary):
+            return [question]
+        try:
+            return self.parse(await self.chain.ainvoke(self.rewrite_input(messages, summary, question)), question)
+        except Exception as e:
+            print(f'Query rewrite failed, retrieving with the raw question: {type(e).__name__}: {e}')
+            return [question]
+
+    def fuse(self, results, top_k):
+        """
+        Reciprocal-rank fusion of the document lists of each query, duplicated chunks are merged.
+        """
+        return reciprocal_rank_fusion(results, top_k, k=self.rrf_k)
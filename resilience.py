@@ -0,0 +1,341 @@
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Any
+
+import httpx
+import requests
+import urllib3
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableLambda
+from metrics import record, UPSTREAM_CALLS, CIRCUIT_STATE
+
+import dotenv
+dotenv.load_dotenv()
+
+### Deadlines, retries and circuit breakers of the upstream calls (embedding Space, Pinecone, LLM).
+### A request is given an overall budget with `request_budget`, every upstream call made while serving it
+### gets the smaller of its own timeout and what is left of the budget. Failed idempotent calls are retried
+### with jittered exponential backoff as long as the budget allows it. Each upstream has a circuit breaker:
+### after `failure_threshold` consecutive failures its calls fail right away for `reset_timeout` seconds,
+### then a single trial call decides whether it closes again.
+### A call also runs under its own timeout as deadline, so any upstream it calls in turn fits in it. Retries
+### happen in one layer only: a call wrapping another upstream would multiply their attempts and count the
+### failures of the inner one against its own breaker (see `ResilientRetriever`).
+
+deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class UpstreamTimeout(UpstreamError, TimeoutError):
+    pass
+
+
+class DeadlineExceeded(UpstreamError, TimeoutError):
+    pass
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+class UpstreamStatusError(UpstreamError, ValueError):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@contextmanager
+def request_budget(seconds):
+    """
+    Sets the deadline of the upstream calls made inside the block, and in the tasks and threads it starts.
+    """
+    token = deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        deadline.reset(token)
+
+
+def remaining():
+    end = deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+RETRYABLE_ERRORS = (TimeoutError, ConnectionError, requests.ConnectionError, requests.Timeout,
+                    httpx.TransportError, urllib3.exceptions.HTTPError)
+
+def is_retryable(error):
+    if isinstance(error, (CircuitOpen, DeadlineExceeded)):
+        return False
+    ### HTTP errors of the requests / httpx / groq / pinecone clients, throttling and server side failures only
+    status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+    if isinstance(status, int):
+        return status in (408, 429) or status >= 500
+    return isinstance(error, RETRYABLE_ERRORS) or type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name, failure_threshold = 5, reset_timeout = 30.0):
+        """
+        Args:
+            name (str): Upstream name, label of the metrics.
+            failure_threshold (int): Consecutive failures opening the circuit.
+            reset_timeout (float): Seconds the circuit stays open before a trial call is let through.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+        CIRCUIT_STATE.labels(name).set(self.state)
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.set_state(self.HALF_OPEN)
+                return
+            if self.state != self.CLOSED:
+                ### Open, or half open with the trial call still running
+                raise CircuitOpen(f'{self.name} is unavailable, retrying in at most {self.reset_timeout:g}s')
+
+    def available(self):
+        ### Read only, `allow` is what lets the trial call through
+        return self.state == self.CLOSED or (self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.set_state(self.CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.set_state(self.OPEN)
+
+    def release(self):
+        ### Call cancelled or failed for a reason that says nothing about the upstream
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.opened_at = time.monotonic() - self.reset_timeout
+                self.set_state(self.OPEN)
+
+    def set_state(self, state):
+        if state != self.state:
+            record('circuit', upstream=self.name, state=('closed', 'half_open', 'open')[state])
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(state)
+
+
+class Upstream:
+    def __init__(self, name, timeout = 10.0, retries = 2, backoff = 0.2, max_backoff = 2.0,
+                 failure_threshold = 5, reset_timeout = 30.0):
+        """
+        Args:
+            name (str): Upstream name, label of the metrics.
+            timeout (float): Seconds given to one call when the request budget leaves more.
+            retries (int): Retries of a failed idempotent call.
+            backoff (float): Base delay of the retries, doubled on each attempt and fully jittered.
+            max_backoff (float): Upper bound of the retry delay.
+            failure_threshold (int): See `CircuitBreaker`.
+            reset_timeout (float): See `CircuitBreaker`.
+        """
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+
+    def call(self, func, idempotent = True):
+        """
+        Calls `func(timeout)` with the breaker, deadline and retries applied. `func` must pass the timeout
+        on to its client, a blocking call cannot be interrupted from outside (see `call_with_timeout`).
+        `idempotent` can be a callable, checked after a failure, e.g. to retry only before any output.
+        """
+        attempt = 0
+        while True:
+            timeout = self.before_call()
+            try:
+                with request_budget(timeout):
+                    result = func(timeout)
+            except Exception as e:
+                delay = self.after_failure(e, attempt, idempotent)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.after_success()
+            return result
+
+    async def acall(self, func, idempotent = True):
+        """
+        Async version of `call`, `func(timeout)` returns an awaitable which is also cancelled at the timeout.
+        """
+        attempt = 0
+        while True:
+            timeout = self.before_call()
+            try:
+                try:
+                    with request_budget(timeout):
+                        result = await asyncio.wait_for(func(timeout), timeout)
+                except asyncio.TimeoutError:
+                    raise UpstreamTimeout(f'{self.name} did not answer within {timeout:.2f}s')
+            except Exception as e:
+                delay = self.after_failure(e, attempt, idempotent)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                ### Cancelled, the caller went away
+                self.breaker.release()
+                raise
+            self.after_success()
+            return result
+
+    def before_call(self):
+        try:
+            self.breaker.allow()
+        except CircuitOpen:
+            UPSTREAM_CALLS.labels(self.name, 'short_circuit').inc()
+            raise
+        left = remaining()
+        if left is not None and left <= 0:
+            self.breaker.release()
+            UPSTREAM_CALLS.labels(self.name, 'deadline').inc()
+            raise DeadlineExceeded(f'No time left in the request budget to call {self.name}')
+        return self.timeout if left is None else min(self.timeout, left)
+
+    def after_success(self):
+        self.breaker.success()
+        UPSTREAM_CALLS.labels(self.name, 'ok').inc()
+
+    def failed(self, error):
+        """
+        Updates the breaker after a failed call, returns whether the error is transient.
+        """
+        retryable = is_retryable(error)
+        if retryable:
+            self.breaker.failure()
+        else:
+            self.breaker.release()
+        return retryable
+
+    def after_failure(self, error, attempt, idempotent):
+        """
+        Updates the breaker, returns the delay before the next attempt or None when the error is final.
+        """
+        retryable = self.failed(error)
+        if callable(idempotent):
+            idempotent = idempotent()
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        left = remaining()
+        if not (retryable and idempotent and attempt < self.retries) or (left is not None and delay >= left):
+            UPSTREAM_CALLS.labels(self.name, 'error').inc()
+            return None
+        UPSTREAM_CALLS.labels(self.name, 'retry').inc()
+        record('retry', upstream=self.name, attempt=attempt + 1, error=type(error).__name__)
+        return delay
+
+
+upstreams = {}
+upstreams_lock = threading.Lock()
+
+def get_upstream(name, timeout = 10.0, retries = 2):
+    """
+    Returns the shared `Upstream` of `name`, so every client of a service sees the same breaker.
+    Its settings are read from <NAME>_TIMEOUT, <NAME>_RETRIES, <NAME>_BREAKER_THRESHOLD and <NAME>_BREAKER_RESET.
+    """
+    with upstreams_lock:
+        if name not in upstreams:
+            prefix = name.upper()
+            upstreams[name] = Upstream(
+                name,
+                timeout = float(os.environ.get(f'{prefix}_TIMEOUT', timeout)),
+                retries = int(os.environ.get(f'{prefix}_RETRIES', retries)),
+                failure_threshold = int(os.environ.get(f'{prefix}_BREAKER_THRESHOLD', 5)),
+                reset_timeout = float(os.environ.get(f'{prefix}_BREAKER_RESET', 30)),
+            )
+        return upstreams[name]
+
+
+### Blocking clients without a timeout parameter run here, the caller stops waiting at the timeout
+blocking_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='upstream')
+
+def call_with_timeout(func, *args, timeout = None):
+    future = blocking_pool.submit(contextvars.copy_context().run, func, *args)
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise UpstreamTimeout(f'No answer within {timeout:.2f}s')
+
+def run_blocking(func, *args):
+    ### Awaitable version, to be awaited under a timeout (`Upstream.acall`). A hung call holds a thread of this
+    ### bounded pool, never one of the default executor the checkpointer and `asyncio.to_thread` rely on.
+    return asyncio.wrap_future(blocking_pool.submit(contextvars.copy_context().run, func, *args))
+
+
+class ResilientRetriever(BaseRetriever):
+    """
+    Retriever calling `retriever` through `upstream`. Searches are read-only, so they are always retried.
+    The query of a vector store retriever is embedded first, through the embedding client and its own upstream,
+    so only the search itself is retried here and an embedding outage never opens the circuit of the store.
+    """
+    retriever: Any
+    upstream: Any
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        vectorstore = getattr(self.retriever, 'vectorstore', None)
+        if vectorstore is None:
+            return self.upstream.call(lambda timeout: call_with_timeout(self.retriever.invoke, query, timeout=timeout))
+        embedding = vectorstore.embeddings.embed_query(query)
+        return self.upstream.call(lambda timeout: call_with_timeout(self.search, embedding, timeout=timeout))
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        vectorstore = getattr(self.retriever, 'vectorstore', None)
+        if vectorstore is None:
+            return await self.upstream.acall(lambda timeout: self.retriever.ainvoke(query))
+        embedding = await vectorstore.embeddings.aembed_query(query)
+        return await self.upstream.acall(lambda timeout: run_blocking(self.search, embedding))
+
+    def search(self, embedding):
+        vectorstore = self.retriever.vectorstore
+        ### langchain-pinecone only implements the variant with the scores
+        if hasattr(vectorstore, 'similarity_search_by_vector_with_score'):
+            return [doc for doc, _ in vectorstore.similarity_search_by_vector_with_score(embedding, **self.retriever.search_kwargs)]
+        return vectorstore.similarity_search_by_vector(embedding, **self.retriever.search_kwargs)
+
+
+def resilient(runnable, upstream):
+    """
+    Wraps an idempotent runnable (LLM calls whose output is not streamed to the user) so it is called through
+    `upstream`. The timeout is passed to its `invoke`, chat models forward it to their client.
+    """
+    def invoke(input, config):
+        return upstream.call(lambda timeout: runnable.invoke(input, config, timeout=timeout))
+
+    async def ainvoke(input, config):
+        return await upstream.acall(lambda timeout: runnable.ainvoke(input, config, timeout=timeout))
+
+    return RunnableLambda(invoke, afunc=ainvoke, name=f'resilient_{upstream.name}')
@@ -0,0 +1,116 @@
+import json
+
+import numpy as np
+from metrics import record, ROUTER_DECISIONS
+
+### Picks the model tier of a question before it reaches the LLM.
+### The question embedding (the one the retriever uses next, served by the embedding cache) is compared to
+### labelled example questions: lookups of a single fact or small talk go to the small, fast model, open
+### ended questions to the large one. Long questions skip the comparison and go to the large model, and so
+### does everything when the embedding fails. `margin` moves the boundary, a higher value sends more
+### questions to the large model.
+
+SMALL_EXAMPLES = [
+    "hi", "hello", "hey there", "thanks!", "thank you, bye", "who are you?",
+    "what's his email?", "what is his phone number?", "where does he live?", "what is his linkedin?",
+    "what is his github?", "where did he study?", "which university did he go to?", "what is his current job?",
+    "where does he work?", "what is his job title?", "what languages does he speak?", "is he open to work?",
+    "does he know python?", "what degree does he have?", "when did he graduate?", "what is his nationality?",
+    "how many years of experience does he have?", "which certifications does he have?",
+]
+
+LARGE_EXAMPLES = [
+    "compare his experience in nlp and computer vision",
+    "why would he be a good fit for a senior machine learning engineer role?",
+    "summarize his research projects and their impact",
+    "explain the architecture of the U-Rankly project and the decisions behind it",
+    "write a short cover letter for him for a data scientist position",
+    "what are his strengths and weaknesses as a data scientist?",
+    "how has his career progressed over the years?",
+    "describe a challenging project he worked on and how he solved it",
+    "how would he approach building a recommendation system from scratch?",
+    "what could he bring to a startup working on generative ai, and what would he need to learn?",
+    "walk me through his experience with deep learning, from his studies to his latest job",
+    "given his background, which roles should he apply to and why?",
+]
+
+
+class QueryRouter:
+    def __init__(self, embedding_model, small_examples = None, large_examples = None, k = 3, margin = 0.0,
+                 max_small_words = 25):
+        """
+        Args:
+            embedding_model: Embeddings used for the questions and the examples.
+            small_examples (list[str], optional): Questions for the small model, SMALL_EXAMPLES by default.
+            large_examples (list[str], optional): Questions for the large model, LARGE_EXAMPLES by default.
+            k (int): Number of nearest examples of each tier averaged into its score.
+            margin (float): The small model is picked when its score beats the large one by more than this.
+            max_small_words (int): Longer questions always go to the large model.
+        """
+        self.embedding_model = embedding_model
+        self.examples = {'small': small_examples or SMALL_EXAMPLES, 'large': large_examples or LARGE_EXAMPLES}
+        self.k = k
+        self.margin = margin
+        self.max_small_words = max_small_words
+        self.vectors = None
+
+    @classmethod
+    def from_file(cls, embedding_model, path, **kwargs):
+        """
+        Reads the examples from a JSON file {"small": [...], "large": [...]}.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            examples = json.load(f)
+        return cls(embedding_model, examples['small'], examples['large'], **kwargs)
+
+    ### The examples are embedded once, on the first question or by `afit` at warm-up
+    def fit(self):
+        if self.vectors is None:
+            self.vectors = {tier: self.normalize(self.embedding_model.embed_documents(texts)) for tier, texts in self.examples.items()}
+
+    async def afit(self):
+        if self.vectors is None:
+            self.vectors = {tier: self.normalize(await self.embedding_model.aembed_documents(texts)) for tier, texts in self.examples.items()}
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    def route(self, question):
+        if self.is_long(question):
+            return self.decide('large', 'length')
+        try:
+            self.fit()
+            embedding = self.embedding_model.embed_query(question)
+        except Exception as e:
+            return self.decide('large', f'error:{type(e).__name__}')
+        return self.classify(embedding)
+
+    async def aroute(self, question):
+        if self.is_long(question):
+            return self.decide('large', 'length')
+        try:
+            await self.afit()
+            embedding = await self.embedding_model.aembed_query(question)
+        except Exception as e:
+            return self.decide('large', f'error:{type(e).__name__}')
+        return self.classify(embedding)
+
+    def is_long(self, question):
+        return len(question.split()) > self.max_small_words
+
+    def classify(self, embedding):
+        query = self.normalize(embedding)
+        scores = {}
+        for tier, vectors in self.vectors.items():
+            similarities = vectors @ query
+            k = min(self.k, len(similarities))
+            scores[tier] = float(np.mean(np.partition(similarities, -k)[-k:]))
+        margin = scores['small'] - scores['large']
+        return self.decide('small' if margin > self.margin else 'large', 'similarity', **scores, margin=round(margin, 4))
+
+    def decide(self, tier, reason, **scores):
+        ROUTER_DECISIONS.labels(tier, reason.split(':')[0]).inc()
+        record('route', tier=tier, reason=reason, **{name: round(value, 4) for name, value in scores.items()})
+        return tier
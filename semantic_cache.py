@@ -0,0 +1,111 @@
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+
+### Answer cache keyed on the query embedding.
+### Most of the traffic is a handful of near-duplicate first questions, a new question whose embedding is
+### within `threshold` cosine similarity of a cached one gets the stored answer without retrieval or LLM call.
+
+
+class SemanticCache:
+    def __init__(self, threshold = 0.95, max_size = 1024, ttl = 60 * 60, watch_paths = (), fingerprint = ''):
+        """
+        Args:
+            threshold (float): Minimum cosine similarity between two queries to reuse an answer.
+            max_size (int): Maximum number of cached answers, the least recently used are evicted first.
+            ttl (float): Seconds after which a cached answer expires.
+            watch_paths (tuple[str]): Files (system prompt, index) whose change invalidates the whole cache.
+            fingerprint (str): Extra value mixed into the invalidation key, e.g. the formatted system prompt.
+        """
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.watch_paths = watch_paths
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.version = self.current_version()
+        self.vectors = None
+        self.answers = []
+        self.created_at = np.zeros(max_size)
+        self.last_used = np.zeros(max_size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def current_version(self):
+        key = [self.fingerprint]
+        for path in self.watch_paths:
+            stat = os.stat(path) if os.path.exists(path) else None
+            key.append(f'{path}:{stat.st_mtime_ns}:{stat.st_size}' if stat else f'{path}:missing')
+        return hashlib.sha256('\0'.join(key).encode('utf-8')).hexdigest()
+
+    def check_version(self):
+        version = self.current_version()
+        if version != self.version:
+            self.version = version
+            self.clear()
+            self.invalidations += 1
+
+    def clear(self):
+        self.vectors = None
+        self.answers = []
+
+    def normalize(self, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def lookup(self, embedding):
+        """
+        Returns the cached answer of the most similar query above the threshold, None on a miss.
+        """
+        query = self.normalize(embedding)
+        with self.lock:
+            self.check_version()
+            if self.answers:
+                now = time.time()
+                size = len(self.answers)
+                scores = self.vectors[:size] @ query
+                scores[now - self.created_at[:size] > self.ttl] = -np.inf
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.last_used[best] = now
+                    self.hits += 1
+                    return self.answers[best]
+            self.misses += 1
+            return None
+
+    def add(self, embedding, answer):
+        vector = self.normalize(embedding)
+        with self.lock:
+            self.check_version()
+            now = time.time()
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+            size = len(self.answers)
+            if size < self.max_size:
+                slot = size
+                self.answers.append(answer)
+            else:
+                ### Reuse an expired slot if there is one, else the least recently used
+                expired = np.flatnonzero(now - self.created_at > self.ttl)
+                slot = int(expired[0]) if len(expired) else int(np.argmin(self.last_used))
+                self.answers[slot] = answer
+                self.evictions += 1
+            self.vectors[slot] = vector
+            self.created_at[slot] = now
+            self.last_used[slot] = now
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self.answers),
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
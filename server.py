@@ -1,42 +1,259 @@
 from fastapi import FastAPI, Request
-from mygraph_v2 import MyAgent
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from metrics import latest_metrics, start_trace, finish_trace, REQUEST_DURATION, REQUEST_TTFB, REQUESTS_IN_FLIGHT, \
+    REQUESTS_REJECTED, ADMISSION_WAIT, REQUESTS_ABANDONED
+from admission import AdmissionController, RateLimiter, Rejected, ThreadFileLocks
 import uvicorn
-import asyncio
-from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import JSONResponse
+from starlette.background import BackgroundTask
+import anyio
+import asyncio
+import ipaddress
 import os
+import time
+from contextlib import asynccontextmanager
 import dotenv
 dotenv.load_dotenv()
 
-workflow = MyAgent().compile_graph()
+### The agent is built in the background once the server is up, so the port opens right away and /ready
+### tells the load balancer when to route traffic. Chat requests arriving earlier wait for the startup.
+startup = None
+startup_error = None
+
+def build_agent():
+    ### The LangChain stack is imported here, in a worker thread, instead of when the module is imported
+    from mygraph_v2 import MyAgent
+    agent = MyAgent()
+    return agent, agent.compile_graph()
+
+async def build_with_retries():
+    ### Retried in the background with backoff, a transient Pinecone or Space error at boot does not leave the
+    ### instance unready for good. Chat requests fail fast while the last attempt failed.
+    global startup_error
+    delay = float(os.environ.get('STARTUP_RETRY_DELAY', 1))
+    while True:
+        try:
+            agent, workflow = await asyncio.to_thread(build_agent)
+        except Exception as e:
+            startup_error = e
+            print(f'Startup failed, retrying in {delay:g}s: {type(e).__name__}: {e}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, float(os.environ.get('STARTUP_RETRY_MAX_DELAY', 60)))
+            continue
+        startup_error = None
+        return agent, workflow
+
+async def start_agent():
+    agent, workflow = await build_with_retries()
+    if os.environ.get('WARMUP', '1') == '1':
+        try:
+            await agent.warm_up()
+        except Exception as e:
+            print(f'Warm-up failed, serving anyway: {type(e).__name__}: {e}')
+    return workflow
+
+async def get_workflow():
+    if startup.done() or startup_error is None:
+        return await asyncio.shield(startup)
+    raise startup_error
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global startup
+    startup = asyncio.create_task(start_agent())
+    yield
+    startup.cancel()
+
+### Limits are per worker process, the order of the turns of a thread is kept across the workers sharing the sqlite checkpointer
+thread_locks = None
+if os.environ.get('CHECKPOINTER', 'memory') == 'sqlite':
+    thread_locks = ThreadFileLocks(os.environ.get('THREAD_LOCK_DIR', os.environ.get('CHECKPOINT_PATH', 'checkpoints.sqlite') + '.locks'))
+admission = AdmissionController(
+    max_concurrent = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 32)),
+    max_queued = int(os.environ.get('MAX_QUEUED_REQUESTS', 64)),
+    queue_timeout = float(os.environ.get('QUEUE_TIMEOUT', 10)),
+    max_thread_queue = int(os.environ.get('MAX_THREAD_QUEUE', 2)),
+    thread_locks = thread_locks,
+)
+rate_limit = float(os.environ.get('RATE_LIMIT_PER_MINUTE', 30))
+rate_limiter = RateLimiter(rate_limit, burst = int(os.environ.get('RATE_LIMIT_BURST', 10))) if rate_limit > 0 else None
+
+### Proxies whose X-Forwarded-For is trusted (the Streamlit app, a load balancer), comma separated addresses or networks
+trusted_proxies = [ipaddress.ip_network(network.strip(), strict=False)
+                   for network in os.environ.get('TRUSTED_PROXIES', '').split(',') if network.strip()]
+
+def is_trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in trusted_proxies)
+
+def client_key(request: Request):
+    ### Rate limited by client address, the caller cannot pick it. Behind trusted proxies it is the rightmost
+    ### address of X-Forwarded-For they did not add themselves, the Streamlit app forwards the address of its user.
+    ### X-Client-Id only identifies callers whose address is unknown.
+    address = request.client.host if request.client else None
+    if address and is_trusted_proxy(address):
+        for forwarded in reversed(request.headers.get('X-Forwarded-For', '').split(',')):
+            forwarded = forwarded.strip()
+            if not forwarded:
+                continue
+            address = forwarded
+            if not is_trusted_proxy(forwarded):
+                break
+    return address or request.headers.get('X-Client-Id') or 'unknown'
+
 app = FastAPI(title = 'Fat.ai', 
-              description = "My personal agentic AI, whos capable of answering the user's questions about me and also execute task like sendind and email to my mail, notifying me about the person enquired about me. ")
+              description = "My personal agentic AI, whos capable of answering the user's questions about me and also execute task like sendind and email to my mail, notifying me about the person enquired about me. ",
+              lifespan = lifespan)
+
+async def graph_tokens(workflow, state: dict, thread_id: str):
+    from mygraph_v2 import ThinkStreamFilter
+    from resilience import request_budget
+    from langchain_core.messages import AIMessageChunk
+    stream_filter = ThinkStreamFilter()
+    ### Forward the LLM tokens as they are generated, other nodes only emit full messages.
+    ### An answer served by the semantic cache comes as a single update instead.
+    stream = workflow.astream(state, config={'configurable': {'thread_id': thread_id}}, stream_mode=['messages', 'updates'])
+    ### Deadline of every upstream call made for this request, the nodes run in tasks copying this context
+    with request_budget(float(os.environ.get('REQUEST_BUDGET', 90))):
+        try:
+            async for mode, chunk in stream:
+                if mode == 'messages':
+                    message, metadata = chunk
+                    if metadata.get('langgraph_node') == 'invoke_llm' and isinstance(message, AIMessageChunk):
+                        token = stream_filter.feed(message.content)
+                        if token:
+                            yield token
+                elif chunk.get('semantic_cache', {}).get('cache_status') == 'hit':
+                    yield chunk['semantic_cache']['llm_response']
+        finally:
+            ### Stops the running nodes and their LLM / embedding calls if the consumer went away
+            await stream.aclose()
+    token = stream_filter.flush()
+    if token:
+        yield token
+
+async def in_task(tokens):
+    """
+    Iterates `tokens` in a task of its own. The graph nodes are only stopped by a plain task cancellation,
+    not by the cancel scope Starlette uses for the response when the client disconnects.
+    """
+    queue = asyncio.Queue()
+    async def produce():
+        async for token in tokens:
+            queue.put_nowait(token)
+    producer = asyncio.create_task(produce())
+    producer.add_done_callback(lambda task: queue.put_nowait(None))
+    try:
+        while (token := await queue.get()) is not None:
+            yield token
+        producer.result()
+    finally:
+        if not producer.done():
+            producer.cancel()
+            with anyio.CancelScope(shield=True):
+                await asyncio.wait([producer])
 
-async def stream_response(input: dict):
+async def stream_response(workflow, input: dict, release = None):
     state = {'user_input': input.get('user_input', '')}
     thread_id = input.get('thread_id', None)
     if thread_id:
-        for chunk in workflow.stream(state, config={'configurable': {'thread_id': thread_id}}):
-            if 'invoke_llm' in chunk:
-                yield chunk['invoke_llm']['llm_response']
-            await asyncio.sleep(0)
-
-class SecretKeyMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        """
-        Middleware to check if the request contains a valid secret key.
-        """
-        if request.method == "POST":
-            client_secret = request.headers.get("X-SECRET-KEY")
-            if client_secret != os.environ['SECRET_KEY']:
-                return JSONResponse(status_code=403, content={"detail": "Forbidden: Invalid secret key"})
+        trace = start_trace(thread_id=thread_id, user_input_chars=len(state['user_input']))
+        start = time.perf_counter()
+        ttfb, response_chars, status = None, 0, 'ok'
+        REQUESTS_IN_FLIGHT.inc()
+        tokens = in_task(graph_tokens(workflow, state, thread_id))
+        try:
+            async for token in tokens:
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                    REQUEST_TTFB.observe(ttfb)
+                response_chars += len(token)
+                yield token
+        except (GeneratorExit, asyncio.CancelledError):
+            status = 'cancelled'
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            ### Shielded, a disconnect cancels the whole response task and any plain await would be cancelled too
+            with anyio.CancelScope(shield=True):
+                ### Closing the token stream cancels the graph if it is still running
+                await tokens.aclose()
+                if status == 'cancelled':
+                    REQUESTS_ABANDONED.labels('streaming' if ttfb is not None else 'before_first_token').inc()
+                ### A failed turn is dropped too, its question and retrieved context would stay in every later prompt
+                if status != 'ok':
+                    from checkpointer import discard_unfinished_turn
+                    await discard_unfinished_turn(workflow, thread_id)
+            if release:
+                release()
+            REQUESTS_IN_FLIGHT.dec()
+            duration = time.perf_counter() - start
+            REQUEST_DURATION.observe(duration)
+            finish_trace(trace, status=status, response_chars=response_chars, duration_ms=round(duration * 1000, 3),
+                         ttfb_ms=round(ttfb * 1000, 3) if ttfb is not None else None)
+
+class SecretKeyMiddleware:
+    """
+    Middleware to check if the request contains a valid secret key.
+    A plain ASGI middleware, so the disconnect of a client still reaches the streaming response and cancels it.
+    """
+    def __init__(self, app):
+        self.app = app
 
-        response = await call_next(request)
-        return response
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == "POST":
+            client_secret = Request(scope).headers.get("X-SECRET-KEY")
+            if client_secret != os.environ['SECRET_KEY']:
+                response = JSONResponse(status_code=403, content={"detail": "Forbidden: Invalid secret key"})
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
 
 app.add_middleware(SecretKeyMiddleware)
 
 @app.post('/chat/stream')
-async def run(input: dict):
-    return StreamingResponse(stream_response(input), media_type='text/plain')
+async def run(input: dict, request: Request):
+    try:
+        if rate_limiter:
+            rate_limiter.check(client_key(request))
+        workflow = await get_workflow()
+    except Rejected as e:
+        REQUESTS_REJECTED.labels(e.reason).inc()
+        return e.response()
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"detail": f"Agent unavailable: {type(e).__name__}"})
+
+    thread_id = input.get('thread_id', None)
+    if not thread_id:
+        return StreamingResponse(stream_response(workflow, input), media_type='text/plain')
+    ### Admitted before the response starts, so a rejection can still be a 429/503.
+    ### The slot and the thread lock are released when the stream ends, whatever the reason.
+    start = time.perf_counter()
+    try:
+        release = await admission.acquire(thread_id)
+    except Rejected as e:
+        REQUESTS_REJECTED.labels(e.reason).inc()
+        return e.response()
+    ADMISSION_WAIT.observe(time.perf_counter() - start)
+    ### Starlette stops iterating the body when the client disconnects, closing it runs the cleanup right away
+    body = stream_response(workflow, input, release)
+    return StreamingResponse(body, media_type='text/plain', background=BackgroundTask(body.aclose))
+
+@app.get('/ready')
+async def ready():
+    if startup_error is not None:
+        return JSONResponse(status_code=503, content={"status": "retrying", "error": type(startup_error).__name__})
+    if startup is None or not startup.done():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    if startup.cancelled():
+        return JSONResponse(status_code=503, content={"status": "failed"})
+    return {"status": "ready"}
+
+@app.get('/metrics')
+async def metrics():
+    return Response(latest_metrics(), media_type=CONTENT_TYPE_LATEST)
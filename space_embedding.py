@@ -1,49 +1,187 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 # from langchain.embeddings.base import Embeddings
 from langchain_core.embeddings import Embeddings
+from embedding_cache import EmbeddingCache
+from metrics import timed, EMBEDDING_DURATION, EMBEDDING_PAYLOAD
+from resilience import Upstream, UpstreamStatusError, get_upstream
 
 ### This is a custom embedding class for Hugging Face Spaces.
 ### It allows you to use models hosted on Hugging Face Spaces for generating embeddings.
+### The `/embed` endpoint takes {"user_input": text} and returns {"output": embedding}, or a list of texts
+### and a list of embeddings in the same order for the batched calls.
 class HuggingFaceSpaceEmbeddings(Embeddings):
-    def __init__(self, space_url: str, secret_key: str = None):
+    def __init__(self, space_url: str, secret_key: str = None, cache: EmbeddingCache = None,
+                 batch_size: int = 32, max_workers: int = 4, upstream: Upstream = None):
         """
         Args:
             space_url (str): The URL of your Hugging Face Space.
             secret_key (str, optional): The secret key to authenticate requests (if needed).
+            cache (EmbeddingCache, optional): Cache checked before calling the Space, hits skip the request.
+            batch_size (int): Number of texts sent per request by `embed_documents`.
+            max_workers (int): Number of batches in flight at the same time, also the size of the connection pool.
+            upstream (Upstream, optional): Timeout, retries and circuit breaker of the requests, the shared 'embedding' one by default.
         """
-        self.space_url = space_url.rstrip("/")  
-        self.secret_key = secret_key  
+        self.space_url = space_url.rstrip("/")
+        self.secret_key = secret_key
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.upstream = upstream or get_upstream('embedding', timeout=10.0)
+
+        ### Keep-alive connections, so only the first request pays the TCP + TLS handshake
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+        self.async_client = None
+        self.async_client_loop = None
 
     def embed_documents(self, texts):
         """
         Generates embeddings for a list of texts.
         """
         if type(texts) == str:
-            return self._get_embedding(texts)
-        return [self._get_embedding(text) for text in texts]
+            return self.embed_query(texts)
+        embeddings = self._lookup(texts)
+        batches = self._missing_batches(embeddings)
+        if len(batches) <= 1:
+            results = [self._get_embeddings([texts[i] for i in batch]) for batch in batches]
+        else:
+            ### Each batch runs in a copy of the caller's context, so it keeps the deadline of the request
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, self._get_embeddings, [texts[i] for i in batch])
+                           for batch in batches]
+                results = [future.result() for future in futures]
+        return self._fill(texts, embeddings, batches, results)
 
     def embed_query(self, text):
         """
         Generates an embedding for a single query.
         """
-        return self._get_embedding(text)
+        embedding = self._lookup([text])[0]
+        if embedding is None:
+            embedding = self._get_embedding(text)
+            self._store(text, embedding)
+        return embedding
 
-    def _get_embedding(self, text):
+    async def aembed_documents(self, texts):
         """
-        Sends a POST request to the hosted model and retrieves embeddings.
+        Async version of `embed_documents`, at most `max_workers` batches are sent concurrently.
         """
-        data = {"user_input": text}
+        if type(texts) == str:
+            return await self.aembed_query(texts)
+        embeddings = self._lookup(texts)
+        batches = self._missing_batches(embeddings)
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run(batch):
+            async with semaphore:
+                return await self._aget_embeddings([texts[i] for i in batch])
+
+        results = await asyncio.gather(*[run(batch) for batch in batches])
+        return self._fill(texts, embeddings, batches, results)
+
+    async def aembed_query(self, text):
+        """
+        Async version of `embed_query`.
+        """
+        embedding = self._lookup([text])[0]
+        if embedding is None:
+            embedding = await self._aget_embedding(text)
+            self._store(text, embedding)
+        return embedding
+
+    ### Cache helpers
+    def _lookup(self, texts):
+        if self.cache is None:
+            return [None] * len(texts)
+        return [self.cache.get(self.space_url, text) for text in texts]
+
+    def _store(self, text, embedding):
+        if self.cache is not None:
+            self.cache.set(self.space_url, text, embedding)
+
+    def _missing_batches(self, embeddings):
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+
+    def _fill(self, texts, embeddings, batches, results):
+        for batch, batch_embeddings in zip(batches, results):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+                self._store(texts[i], embedding)
+        return embeddings
+
+    ### HTTP calls
+    def _headers(self):
         headers = {"Content-Type": "application/json"}
         if self.secret_key:
-            headers["X-SECRET-KEY"] = self.secret_key  
-
-        response = requests.post(
-            f"{self.space_url}/embed",
-            json=data,
-            headers=headers
-        )
-        if response.status_code == 200:
-            return response.json()["output"]  
-        else:
-            raise ValueError(f"Error {response.status_code}: {response.text}")
+            headers["X-SECRET-KEY"] = self.secret_key
+        return headers
+
+    def _parse_response(self, response, expected = None):
+        ### Works for both requests and httpx responses
+        request_body = response.request.content if isinstance(response, httpx.Response) else response.request.body
+        EMBEDDING_PAYLOAD.labels('request').observe(len(request_body or b''))
+        EMBEDDING_PAYLOAD.labels('response').observe(len(response.content))
+        if response.status_code != 200:
+            raise UpstreamStatusError(response.status_code, f"Error {response.status_code}: {response.text}")
+        output = response.json()["output"]
+        if expected is not None and len(output) != expected:
+            raise ValueError(f"Expected {expected} embeddings from {self.space_url}, got {len(output)}")
+        return output
+
+    ### Embedding is idempotent, every request goes through `self.upstream` and is retried on transient failures
+    def _get_embedding(self, text):
+        """
+        Sends a POST request to the hosted model and retrieves embeddings.
+        """
+        return self.upstream.call(lambda timeout: self._post(text, 'single', timeout))
+
+    def _get_embeddings(self, texts):
+        """
+        Embeds a whole batch of texts with a single POST request.
+        """
+        return self.upstream.call(lambda timeout: self._post(texts, 'batch', timeout, len(texts)))
+
+    def _post(self, user_input, mode, timeout, expected = None):
+        texts = 1 if expected is None else expected
+        with timed(EMBEDDING_DURATION.labels(mode), 'embedding', mode=mode, texts=texts):
+            response = self.session.post(
+                f"{self.space_url}/embed",
+                json={"user_input": user_input},
+                headers=self._headers(),
+                timeout=timeout
+            )
+        return self._parse_response(response, expected)
+
+    def _get_async_client(self):
+        ### httpx pools are bound to the event loop they were created in
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            limits = httpx.Limits(max_connections=self.max_workers, max_keepalive_connections=self.max_workers)
+            self.async_client = httpx.AsyncClient(limits=limits, timeout=None)
+            self.async_client_loop = loop
+        return self.async_client
+
+    async def _aget_embedding(self, text):
+        return await self.upstream.acall(lambda timeout: self._apost(text, 'single', timeout))
+
+    async def _aget_embeddings(self, texts):
+        return await self.upstream.acall(lambda timeout: self._apost(texts, 'batch', timeout, len(texts)))
 
+    async def _apost(self, user_input, mode, timeout, expected = None):
+        texts = 1 if expected is None else expected
+        with timed(EMBEDDING_DURATION.labels(mode), 'embedding', mode=mode, texts=texts):
+            response = await self._get_async_client().post(
+                f"{self.space_url}/embed",
+                json={"user_input": user_input},
+                headers=self._headers(),
+                timeout=timeout
+            )
+        return self._parse_response(response, expected)